@@ -0,0 +1,390 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re
+from Executor import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class WordBatch(object):
+    """Padded arrays holding a batch of words.
+    feats is words x positions x features of TRUE/FALSE/UNDEF, slots past a word's length are not valid.
+    shared marks the slots of the padding, which is a single Phone in Executor and changes, is deleted
+    and takes insertions as one"""
+
+    def __init__(self, feats, lengths, sylls, boundaries, shared):
+        self.feats = feats
+        self.lengths = lengths
+        self.sylls = sylls
+        self.boundaries = boundaries # phones named "#"
+        self.shared = shared
+
+    def valid(self):
+        return np.arange(self.feats.shape[1])[None, :] < self.lengths[:, None]
+
+
+class BatchExecutor(Executor):
+    """Put whole batches of words through the grammar at once.
+    Every rule is evaluated as vectorized masks over all words and positions,
+    with the same results as Executor"""
+
+    def __init__(self, grammar, batch_size=1024):
+        if np is None:
+            raise ImportError("BatchExecutor requires numpy")
+        Executor.__init__(self, grammar)
+        self.batch_size = batch_size
+        self.n_feats = len(grammar.features)
+        self.syll_index = grammar.features.index("syll")
+        self.char_vectors = {char : self.feature_vector(grammar.phones[phone]) for char, phone in grammar.phone_char_mappings.items()}
+        self.blocks = [(name, [self.compile_rule(rule) for rule in rules]) for name, rules in grammar.rules]
+        self.onsets = [self.compile_template(onset) for onset in grammar.syllables["onsets"]]
+        self.codas = [self.compile_template(coda) for coda in grammar.syllables["codas"]]
+
+    def feature_vector(self, features):
+        """Expand bundle into vector of TRUE/FALSE/UNDEF"""
+        vector = np.empty(self.n_feats, dtype=np.int8)
+        for i in range(self.n_feats):
+            if not features.defined & (1 << i):
+                vector[i] = UNDEF
+            else:
+                vector[i] = TRUE if features.values & (1 << i) else FALSE
+        return vector
+
+    def compile_bundle(self, features):
+        """Indices of defined features and their values, for comparing against feature arrays"""
+        idx = np.array([i for i in range(self.n_feats) if features.defined & (1 << i)], dtype=np.intp)
+        return idx, self.feature_vector(features)[idx]
+
+    def compile_rule(self, rule):
+        """Numeric form of a rule's target, change and environments, taken from its matcher"""
+        matcher = rule.matcher
+        compiled = {"rule": rule,
+                    "insertion": matcher.insertion,
+                    "deletion": None in rule.seg_change,
+                    "seg": [self.compile_bundle(option) for option in matcher.seg_options],
+                    "pre": self.compile_env(matcher.pre_env),
+                    "post": self.compile_env(matcher.post_env),
+                    "sweep": False}
+        if compiled["insertion"]:
+            compiled["inserted"] = (self.char_vectors[rule.insert_char], rule.insert_char == "#")
+        elif not compiled["deletion"]:
+            compiled["change"] = self.compile_bundle(rule.seg_change)
+            # A change to features the left environment looks at is seen by later positions,
+            # so those rules have to be swept one position at a time
+            env_mask = 0
+            for offset, options in matcher.pre_env or ():
+                for defined, values, boundary in options:
+                    env_mask |= defined
+            compiled["sweep"] = bool(env_mask & rule.seg_change.defined)
+        return compiled
+
+    def compile_env(self, env):
+        if env is None:
+            return None
+        return [(offset, [(self.compile_bundle(FeatureBundle(defined, values)), boundary) for defined, values, boundary in options])
+                for offset, options in env]
+
+    def compile_template(self, template):
+        """Syllable template as a list of bundles with its length not counting boundaries"""
+        return [self.compile_bundle(self.grammar.phones[phone]) for phone in template], self.clean_len(template)
+
+    def match_bundle(self, feats, compiled):
+        idx, vals = compiled
+        if not len(idx):
+            return np.ones(feats.shape[:-1], dtype=bool)
+        return (feats[..., idx] == vals).all(axis=-1)
+
+    def make_batch(self, URstrs):
+        """Padded arrays for the underlying representations of input lines"""
+        words = [["#"]*PADDING + ([self.id_phones[id][1] for id in URstr] if isinstance(URstr, tuple) else
+                                  list(re.sub(" ", "", URstr).decode("utf-8"))) + ["#"]*PADDING
+                 for URstr in URstrs]
+        lengths = np.array([len(word) for word in words], dtype=np.intp)
+        width = lengths.max()
+        feats = np.full((len(words), width, self.n_feats), UNDEF, dtype=np.int8)
+        boundaries = np.zeros((len(words), width), dtype=bool)
+        shared = np.zeros((len(words), width), dtype=bool)
+        for b, word in enumerate(words):
+            feats[b, :len(word)] = [self.char_vectors[char] for char in word]
+            boundaries[b, :len(word)] = [char == "#" for char in word]
+            shared[b, :PADDING] = True
+            shared[b, len(word) - PADDING:len(word)] = True
+        sylls = np.full((len(words), width), -1, dtype=np.intp)
+        return WordBatch(feats, lengths, sylls, boundaries, shared)
+
+    def syllabify_batch(self, batch):
+        """Syllabify every word in the batch, as Executor.syllabify does word by word"""
+        valid = batch.valid()
+        nuclei = valid & (batch.feats[..., self.syll_index] == TRUE)
+        sylls = np.where(nuclei, np.cumsum(nuclei, axis=1) - 1, -1)
+        # onsets of different nuclei cannot overlap, so each is found independently
+        onset_lens = self.best_templates(batch.feats, valid & ~nuclei, nuclei, self.onsets, True)
+        self.spread_sylls(sylls, onset_lens, -1)
+        self.wrap_onsets(batch, valid & ~nuclei, nuclei, sylls)
+        coda_lens = self.best_templates(batch.feats, valid & (sylls < 0), nuclei, self.codas, False)
+        self.spread_sylls(sylls, coda_lens, 1)
+        # the padding Phone keeps the syllable Executor gives it last, at its last slot
+        padded = np.nonzero(batch.shared.any(axis=1))[0]
+        if len(padded):
+            last = batch.shared.shape[1] - 1 - np.argmax(batch.shared[padded, ::-1], axis=1)
+            sylls[padded] = np.where(batch.shared[padded], sylls[padded, last][:, None], sylls[padded])
+        batch.sylls = sylls
+
+    def best_templates(self, feats, free, nuclei, templates, is_onset):
+        """Length (not counting boundaries) of longest template matching next to each nucleus"""
+        best = np.zeros(nuclei.shape, dtype=np.intp)
+        width = nuclei.shape[1]
+        for segs, length in templates:
+            if not length:
+                continue
+            found = nuclei.copy()
+            for k, seg in enumerate(segs):
+                shift = k - len(segs) if is_onset else k + 1
+                match = free & self.match_bundle(feats, seg)
+                shifted = np.zeros(nuclei.shape, dtype=bool)
+                if shift < 0 and -shift < width:
+                    shifted[:, -shift:] = match[:, :shift]
+                elif shift > 0 and shift < width:
+                    shifted[:, :-shift] = match[:, shift:]
+                found &= shifted
+            best = np.where(found & (best < length), length, best)
+        return best
+
+    def wrap_onsets(self, batch, free, nuclei, sylls):
+        """Give a nucleus at the start of a word the onset template matching the word's last phones,
+        as Executor.wrapped_onset does"""
+        rows = np.nonzero(nuclei[:, 0])[0]
+        if not len(rows):
+            return
+        lengths = batch.lengths[rows]
+        best = np.zeros(len(rows), dtype=np.intp)
+        for segs, length in self.onsets:
+            if not length:
+                continue
+            found = lengths >= len(segs)
+            for k, seg in enumerate(segs):
+                cols = np.maximum(lengths - len(segs) + k, 0)
+                found &= free[rows, cols] & self.match_bundle(batch.feats[rows, cols], seg)
+            best = np.where(found & (best < length), length, best)
+        for d in range(1, best.max() + 1 if len(best) else 1):
+            reach = best >= d
+            sylls[rows[reach], lengths[reach] - d] = sylls[rows[reach], 0]
+
+    def spread_sylls(self, sylls, lens, direction):
+        """Give the phones within lens of each nucleus the nucleus' syllable"""
+        nucleus_sylls = sylls.copy()
+        width = sylls.shape[1]
+        for d in range(1, min(lens.max(), width - 1) + 1):
+            reach = lens >= d
+            if direction < 0:
+                sylls[:, :-d] = np.where(reach[:, d:], nucleus_sylls[:, d:], sylls[:, :-d])
+            else:
+                sylls[:, d:] = np.where(reach[:, :-d], nucleus_sylls[:, :-d], sylls[:, d:])
+
+    def match_env_batch(self, batch, compiled, cols):
+        """Mask of words x pivot columns whose environment matches"""
+        words = batch.feats.shape[0]
+        n = batch.lengths[:, None]
+        index = np.broadcast_to(cols[None, :], (words, len(cols)))
+        ok = np.ones(index.shape, dtype=bool)
+        if compiled["pre"] is None:
+            return ok
+        pivot = index + 1 if compiled["insertion"] else index
+        start = pivot - len(compiled["pre"])
+        # environments reaching past the start of the word wrap around like a slice
+        start = np.where(start < 0, np.maximum(n + start, 0), start)
+        ok &= start < n
+        ok &= self.match_segs_batch(batch, compiled["pre"], start, pivot)
+        if compiled["post"] is not None:
+            ok &= index + 1 < n
+            ok &= self.match_segs_batch(batch, compiled["post"], index + 1, index)
+        return ok
+
+    def match_segs_batch(self, batch, env, start, pivot):
+        rows = np.arange(batch.feats.shape[0])[:, None]
+        n = batch.lengths[:, None]
+        last = batch.feats.shape[1] - 1
+        pivot_sylls = batch.sylls[rows, np.minimum(pivot, last)]
+        ok = np.ones(start.shape, dtype=bool)
+        for k, (offset, options) in enumerate(env):
+            pos = start + k
+            feats = batch.feats[rows, np.minimum(pos, last)]
+            sylls = batch.sylls[rows, np.minimum(pos, last)]
+            if offset is not None:
+                same_syll = (pivot < n) & (offset + pivot_sylls == sylls)
+            element = np.zeros(start.shape, dtype=bool)
+            for seg, boundary in options:
+                match = self.match_bundle(feats, seg)
+                if offset is not None:
+                    match &= ((sylls < 0) & boundary) | same_syll
+                element |= match
+            ok &= (pos < n) & element
+        return ok
+
+    def match_rule_batch(self, batch, compiled, cols):
+        """Mask of words x columns where the rule applies"""
+        valid = batch.valid()[:, cols]
+        if compiled["insertion"]:
+            seg = valid
+        else:
+            seg = np.zeros(valid.shape, dtype=bool)
+            feats = batch.feats[:, cols]
+            for option in compiled["seg"]:
+                seg |= self.match_bundle(feats, option)
+            seg &= valid
+        if not seg.any():
+            return seg
+        return seg & self.match_env_batch(batch, compiled, cols)
+
+    def apply_rule_batch(self, batch, compiled):
+        """Apply one rule to every word, returning mask of words it applied to"""
+        width = batch.feats.shape[1]
+        if compiled["sweep"]:
+            return self.sweep_batch(batch, compiled)
+        matches = self.match_rule_batch(batch, compiled, np.arange(width))
+        changed = matches.any(axis=1)
+        if not changed.any():
+            return changed
+        if compiled["deletion"]:
+            self.delete_batch(batch, matches)
+        elif compiled["insertion"]:
+            self.insert_batch(batch, matches, compiled["inserted"])
+        elif (matches & batch.shared).any():
+            # a change to the padding shows at all of its slots at once, and later positions see it
+            return self.sweep_batch(batch, compiled)
+        else:
+            idx, vals = compiled["change"]
+            rows, cols = np.nonzero(matches)
+            batch.feats[rows[:, None], cols[:, None], idx[None, :]] = vals
+        return changed
+
+    def sweep_batch(self, batch, compiled):
+        """Apply a feature change one position at a time, so each position sees the changes made before it"""
+        changed = np.zeros(batch.feats.shape[0], dtype=bool)
+        idx, vals = compiled["change"]
+        for i in range(batch.feats.shape[1]):
+            matches = self.match_rule_batch(batch, compiled, np.array([i]))[:, 0]
+            if matches.any():
+                rows = np.nonzero(matches)[0]
+                batch.feats[rows[:, None], i, idx[None, :]] = vals
+                padded = rows[batch.shared[rows, i]]
+                if len(padded):
+                    slots = np.nonzero(batch.shared[padded])
+                    batch.feats[padded[slots[0]][:, None], slots[1][:, None], idx[None, :]] = vals
+                changed |= matches
+        return changed
+
+    def rearrange(self, batch, sources, lengths, inserted=None):
+        """Rebuild batch arrays from source positions per slot, -1 marking an inserted phone"""
+        rows = np.arange(sources.shape[0])[:, None]
+        safe = np.clip(sources, 0, batch.feats.shape[1] - 1)
+        feats = batch.feats[rows, safe]
+        sylls = batch.sylls[rows, safe]
+        boundaries = batch.boundaries[rows, safe]
+        shared = batch.shared[rows, safe]
+        if inserted is not None:
+            new = sources < 0
+            feats[new] = inserted[0]
+            sylls[new] = -1
+            boundaries[new] = inserted[1]
+            shared[new] = False
+        valid = np.arange(sources.shape[1])[None, :] < lengths[:, None]
+        feats[~valid] = UNDEF
+        sylls[~valid] = -1
+        boundaries[~valid] = False
+        shared[~valid] = False
+        batch.feats, batch.sylls, batch.boundaries, batch.shared, batch.lengths = feats, sylls, boundaries, shared, lengths
+
+    def delete_batch(self, batch, matches):
+        """Compact words after removing matched phones. Deleting the padding at any slot deletes all of it"""
+        matches = matches | (batch.shared & (matches & batch.shared).any(axis=1)[:, None])
+        keep = batch.valid() & ~matches
+        lengths = keep.sum(axis=1)
+        order = np.argsort(~keep, axis=1, kind="mergesort")
+        self.rearrange(batch, order[:, :max(lengths.max(), 1)], lengths)
+
+    def insert_batch(self, batch, matches, inserted):
+        """Add new phones after matched positions, placing them the way Executor.apply_rule does"""
+        lengths = batch.lengths.copy()
+        layouts = {}
+        for b in np.nonzero(matches.any(axis=1))[0]:
+            n = batch.lengths[b]
+            flagged = list(np.nonzero(matches[b, :n])[0])
+            # a mark on any slot of the padding is a single mark on its first slot
+            pads = [i for i in flagged if batch.shared[b, i]]
+            if pads:
+                first = np.nonzero(batch.shared[b, :n])[0][0]
+                flagged = sorted([first] + [i for i in flagged if not batch.shared[b, i]])
+            layout = insert_at_sites(range(n), [(i, 2 if batch.boundaries[b, i] else 1, -1) for i in flagged])
+            layouts[b] = layout
+            lengths[b] = len(layout)
+        sources = np.tile(np.arange(lengths.max()), (len(lengths), 1))
+        for b, layout in layouts.items():
+            sources[b, :len(layout)] = layout
+        self.rearrange(batch, sources, lengths, inserted)
+
+    def render_batch(self, batch, words):
+        """Readable form of selected words"""
+        uniques = {}
+        forms = []
+        for b in words:
+            n = batch.lengths[b]
+            chars = []
+            for vector in batch.feats[b, :n]:
+                key = vector.tobytes()
+                if key not in uniques:
+                    defined = 0
+                    values = 0
+                    for i, value in enumerate(vector):
+                        if value != UNDEF:
+                            defined |= 1 << i
+                            if value == TRUE:
+                                values |= 1 << i
+                    char_rep = self.grammar.nearest_char(FeatureBundle(defined, values))
+                    uniques[key] = char_rep if char_rep != "#" else " "
+                chars.append(uniques[key])
+            forms.append("".join(chars).strip())
+        return forms
+
+    def derive_batch(self, URstrs, trace=True):
+        """Derivations of a list of input lines. Without trace only the SRs are rendered"""
+        batch = self.make_batch(URstrs)
+        self.syllabify_batch(batch)
+        words = range(len(URstrs))
+        urs = self.render_batch(batch, words)
+        steps = [[] for word in words]
+        blocks = [[] for word in words]
+        for block, (name, rules) in enumerate(self.blocks):
+            updated = np.zeros(len(URstrs), dtype=bool)
+            for compiled in rules:
+                updated |= self.apply_rule_batch(batch, compiled)
+            changed = list(np.nonzero(updated)[0])
+            for b in changed:
+                blocks[b].append(block)
+            if trace:
+                forms = dict(zip(changed, self.render_batch(batch, changed)))
+                for b in words:
+                    steps[b].append((name, forms.get(b)))
+            self.syllabify_batch(batch)
+        srs = self.render_batch(batch, words)
+        return [Derivation(urs[b], steps[b] if trace else None, srs[b], tuple(blocks[b])) for b in words]
+
+    def derive(self, URstr, trace=True):
+        return self.derive_batch([URstr], trace)[0]
+
+    def derive_all(self, URstrs, trace=True):
+        """Derivations of input lines in batches of batch_size, in input order"""
+        chunk = []
+        for URstr in URstrs:
+            chunk.append(URstr)
+            if len(chunk) == self.batch_size:
+                for derivation in self.derive_batch(chunk, trace):
+                    yield derivation
+                chunk = []
+        if chunk:
+            for derivation in self.derive_batch(chunk, trace):
+                yield derivation
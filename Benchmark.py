@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import codecs
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from Executor import *
+from GlobalGrammar import *
+
+# synthetic grammar and lexicon sizes, overridable from the command line
+SCALES = OrderedDict([
+    ("small", {"features": 12, "phonemes": 20, "rules": 20, "env_length": 2, "syll_share": 0.2,
+               "resize_share": 0.1, "word_length": 6, "words": 1000}),
+    ("medium", {"features": 20, "phonemes": 40, "rules": 60, "env_length": 3, "syll_share": 0.2,
+                "resize_share": 0.1, "word_length": 8, "words": 3000}),
+    ("large", {"features": 40, "phonemes": 80, "rules": 200, "env_length": 4, "syll_share": 0.2,
+               "resize_share": 0.1, "word_length": 12, "words": 10000}),
+])
+
+# the grammar and inputs shipped with the repository
+BASELINE = ("sample_config.txt", "inputs.txt")
+
+SYLLABLE_TEMPLATES = ["V", "CV", "CVC", "CCVC"]
+
+
+def phone_chars(count):
+    """Single characters for phonemes that the rule and config syntax leave alone"""
+    chars = [unichr(c) for c in range(ord("a"), ord("z") + 1)]
+    chars += [unichr(0x100 + i) for i in range(max(count - len(chars), 0))]
+    return chars[:count]
+
+
+def generate_grammar(filename, features=20, phonemes=40, rules=60, env_length=3, syll_share=0.2,
+                     resize_share=0.1, seed=0, break_share=0.0):
+    """Write a random grammar config with the given number of features (besides syll and break),
+    phonemes and rules. Rules have up to env_length environment segments, syll_share of them
+    count syllables and resize_share of them insert or delete. break_share of the rules
+    that change or delete phones target the word boundary #.
+    Returns the vowel and consonant characters and syllable templates for generate_lexicon"""
+    rng = random.Random(seed)
+    # abbreviations are matched as substrings of +/-name, so they all have the same length
+    names = ["f%02d" % i for i in range(features)]
+    chars = phone_chars(phonemes)
+    vowels = chars[:max(1, phonemes//3)]
+    consonants = chars[len(vowels):] or chars[:1]
+
+    def bundle(syllabic):
+        values = ["+syll" if syllabic else "-syll"]
+        values += ["%s%s" % (rng.choice("+-"), name) for name in names if rng.random() < 0.9]
+        return " ".join(values + ["-break"])
+
+    def feature_set(size):
+        return u"[%s]" % u" ".join(u"%s%s" % (rng.choice("+-"), name) for name in rng.sample(names, min(size, len(names))))
+
+    def segment():
+        kind = rng.random()
+        if kind < 0.4:
+            return rng.choice(chars)
+        if kind < 0.7:
+            return rng.choice([u"C", u"V"])
+        return feature_set(rng.randint(1, 2))
+
+    def environment(length, pre):
+        segs = [segment() for i in range(length)]
+        if segs and rng.random() < syll_share:
+            # keep a segment on the far side of the syllable boundary
+            segs.insert(rng.randint(1, len(segs)) if pre else rng.randint(0, len(segs) - 1), SYLL)
+        if segs and rng.random() < 0.2:
+            if pre:
+                segs.insert(0, u"#")
+            else:
+                segs.append(u"#")
+        return u"".join(segs)
+
+    lines = [u"!FEATURES", u"syllabic: syll", u"wordbreak: break"]
+    lines += [u"feature%02d: %s" % (i, name) for i, name in enumerate(names)]
+    lines += [u"", u"!PHONEMES"]
+    lines += [u"%s: %s" % (char, bundle(char in vowels)) for char in chars]
+    lines += [u"", u"!ABBREVIATIONS", u"V: +syll -break", u"C: -syll -break", u"#: +break"]
+    lines += [u"", u"!SYLLABIFICATION"] + SYLLABLE_TEMPLATES
+    lines += [u"", u"!RULES"]
+    null = NULL.decode("utf-8")
+    block = 0
+    for i in range(rules):
+        if i and rng.random() < 0.6:
+            block += 1
+        kind = rng.random()
+        length = rng.randint(0, env_length)
+        if kind < resize_share/2:
+            target, change = null, rng.choice(chars)
+            length = max(length, 1)
+        elif kind < resize_share:
+            target, change = segment(), null
+            length = max(length, 1)
+        else:
+            target = segment()
+            change = rng.choice(chars) if rng.random() < 0.3 else feature_set(rng.randint(1, 2))
+        if target != null and break_share and rng.random() < break_share:
+            target = u"#"
+        rule = u"%s > %s" % (target, change)
+        if length:
+            split = rng.randint(0, length)
+            rule += u" / %s_%s" % (environment(split, True), environment(length - split, False))
+        lines.append(u"B%03d: %s" % (block, rule))
+    with codecs.open(filename, "w", "utf-8") as config:
+        config.write(u"\n".join(lines) + u"\n")
+    return {"vowels": vowels, "consonants": consonants, "templates": SYLLABLE_TEMPLATES}
+
+
+def generate_lexicon(filename, inventory, words=1000, word_length=8, seed=0):
+    """Write words of about word_length phones (on average) built from the inventory's syllable templates"""
+    rng = random.Random(seed)
+    with codecs.open(filename, "w", "utf-8") as lexicon:
+        for i in range(words):
+            target = rng.randint(max(1, word_length//2), word_length*3//2)
+            word = []
+            while len(word) < target:
+                for slot in rng.choice(inventory["templates"]):
+                    word.append(rng.choice(inventory["vowels"] if slot == "V" else inventory["consonants"]))
+            lexicon.write(u"".join(word) + u"\n")
+
+
+def peak_memory():
+    """Peak resident memory of this process so far in kilobytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak//1024 if sys.platform == "darwin" else peak
+
+
+def timed(function, timings, calls, stage):
+    """Wrap function to add its wall time and call count to timings[stage] and calls[stage]"""
+    def wrapper(*args):
+        start = time.time()
+        result = function(*args)
+        timings[stage] += time.time() - start
+        calls[stage] += 1
+        return result
+    return wrapper
+
+
+def time_stages(grammar, words):
+    """Wall time spent in each hot function over one uncached pass over words"""
+    executor = Executor(grammar, 0)
+    stages = ["syllabify", "resyllabify", "apply_rule", "get_word_representation"]
+    timings = dict.fromkeys(stages, 0.0)
+    calls = dict.fromkeys(stages, 0)
+    for stage in stages:
+        setattr(executor, stage, timed(getattr(executor, stage), timings, calls, stage))
+    for word in words:
+        executor.derive(word)
+    return timings, calls
+
+
+def time_end_to_end(executor, words, trace=True):
+    start = time.time()
+    for derivation in executor.derive_all(words, trace):
+        pass
+    return time.time() - start
+
+
+def run_isolated(config, inputs, repeat=3, params=None):
+    """run_case in a worker process of its own, so the peak memory it reports is that case's alone
+    rather than the highest of every case run so far"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_case, (config, inputs, repeat, params))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_case(config, inputs, repeat=3, params=None):
+    """Time parsing, each hot function and whole derivations for one grammar and lexicon, best of repeat"""
+    words = [line for line in read_lines(inputs) if line.strip()]
+    result = OrderedDict([("config", config), ("inputs", inputs), ("params", params or {}), ("words", len(words))])
+    timings = {}
+    start = time.time()
+    grammar = GlobalGrammar(config)
+    timings["parse"] = time.time() - start
+    result["rules"] = sum(len(rules) for name, rules in grammar.rules)
+    result["blocks"] = len(grammar.rules)
+    calls = {}
+    for i in range(repeat):
+        stage_timings, calls = time_stages(grammar, words)
+        for stage, seconds in stage_timings.items():
+            timings[stage] = min(timings.get(stage, seconds), seconds)
+    # engines, with whether they render the forms after each block or only SRs
+    engines = OrderedDict([("executor", (lambda: Executor(grammar, 0), True)),
+                           ("executor_sr_only", (lambda: Executor(grammar, 0), False)),
+                           ("executor_cached", (lambda: Executor(grammar), True))])
+    import BatchExecutor
+    if BatchExecutor.np is not None:
+        engines["batch"] = (lambda: BatchExecutor.BatchExecutor(grammar), True)
+    for engine, (make, trace) in engines.items():
+        timings["end_to_end_" + engine] = min(time_end_to_end(make(), words, trace) for i in range(repeat))
+    result["timings"] = OrderedDict(sorted(timings.items()))
+    result["calls"] = OrderedDict(sorted(calls.items()))
+    result["words_per_second"] = OrderedDict((engine, len(words)/timings["end_to_end_" + engine]
+                                              if timings["end_to_end_" + engine] else 0.0)
+                                             for engine in engines)
+    result["peak_memory_kb"] = peak_memory()
+    return result
+
+
+def report(results, out=sys.stdout):
+    for name, case in results["cases"].items():
+        out.write("%s: %d words, %d rules in %d blocks, peak memory %d KB\n" %
+                  (name, case["words"], case["rules"], case["blocks"], case["peak_memory_kb"]))
+        for stage, seconds in case["timings"].items():
+            count = case["calls"].get(stage)
+            out.write("  %-28s %9.4fs%s\n" % (stage, seconds, " (%d calls)" % count if count else ""))
+        for engine, rate in case["words_per_second"].items():
+            out.write("  %-28s %9.1f words/s\n" % (engine, rate))
+
+
+def compare(results, previous, tolerance=0.1, out=sys.stdout):
+    """Print timing ratios against a previous run and return the (case, stage) pairs
+    that got slower by more than tolerance"""
+    regressions = []
+    for name, case in results["cases"].items():
+        if name not in previous["cases"]:
+            continue
+        out.write("%s vs previous run:\n" % name)
+        old_timings = previous["cases"][name]["timings"]
+        for stage, seconds in case["timings"].items():
+            if not old_timings.get(stage):
+                continue
+            ratio = seconds/old_timings[stage]
+            slower = ratio > 1 + tolerance
+            if slower:
+                regressions.append((name, stage))
+            out.write("  %-28s %9.4fs -> %9.4fs  x%.2f%s\n" %
+                      (stage, old_timings[stage], seconds, ratio, "  REGRESSION" if slower else ""))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Time rule application on the shipped grammar and on synthetic grammars")
+    parser.add_argument("cases", nargs="*", default=["baseline", "small", "medium"],
+                        help="baseline (sample_config.txt with inputs.txt) and/or synthetic scales: %s" % ", ".join(SCALES))
+    for param, value in SCALES["small"].items():
+        parser.add_argument("--" + param.replace("_", "-"), type=type(value),
+                            help="override %s for every synthetic case" % param.replace("_", " "))
+    parser.add_argument("--seed", type=int, default=0, help="random seed for synthetic grammars and lexicons")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the fastest is kept")
+    parser.add_argument("--output", help="file to save results to as JSON")
+    parser.add_argument("--compare", help="results file of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown relative to the previous run that counts as a regression")
+    parser.add_argument("--keep", help="directory to write synthetic grammars and lexicons to instead of a temporary one")
+    options = parser.parse_args(args)
+    workdir = options.keep or tempfile.mkdtemp(prefix="benchmark")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    results = OrderedDict([("created", time.strftime("%Y-%m-%d %H:%M:%S")),
+                           ("python", platform.python_version()),
+                           ("cases", OrderedDict())])
+    try:
+        for name in options.cases:
+            if name == "baseline":
+                results["cases"][name] = run_isolated(BASELINE[0], BASELINE[1], options.repeat)
+                continue
+            if name not in SCALES:
+                parser.error("unknown case %s" % name)
+            params = dict(SCALES[name])
+            for param in params:
+                if getattr(options, param) is not None:
+                    params[param] = getattr(options, param)
+            config = os.path.join(workdir, name + "_config.txt")
+            inputs = os.path.join(workdir, name + "_inputs.txt")
+            inventory = generate_grammar(config, params["features"], params["phonemes"], params["rules"],
+                                         params["env_length"], params["syll_share"], params["resize_share"],
+                                         options.seed)
+            generate_lexicon(inputs, inventory, params["words"], params["word_length"], options.seed)
+            results["cases"][name] = run_isolated(config, inputs, options.repeat, params)
+    finally:
+        if not options.keep:
+            shutil.rmtree(workdir)
+    report(results)
+    if options.output:
+        with open(options.output, "w") as saved:
+            json.dump(results, saved, indent=2)
+    if options.compare:
+        with open(options.compare) as saved:
+            previous = json.load(saved)
+        if compare(results, previous, options.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
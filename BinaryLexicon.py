@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+from array import array
+import mmap
+import os
+import re
+import struct
+import sys
+from DerivationIO import read_lines
+
+# magic, version, bytes per id, words, ids, file positions of the offsets table and of the inventory
+HEADER = struct.Struct("<4sHHQQQQ")
+MAGIC = "PLEX"
+VERSION = 1
+# struct codes of phone ids by their size in bytes
+ID_CODES = {1: "B", 2: "H"}
+OFFSET = struct.Struct("<I")
+LENGTH = struct.Struct("<I")
+CHAR_LENGTH = struct.Struct("<H")
+
+
+def is_lexicon(source):
+    """Whether source names a binary lexicon file rather than text"""
+    if not isinstance(source, basestring) or source == "-" or not os.path.isfile(source):
+        return False
+    with open(source, "rb") as candidate:
+        return candidate.read(len(MAGIC)) == MAGIC
+
+
+def input_inventory(grammar):
+    """Characters input lines can be written with, in a fixed order, so lexicons converted
+    for the same grammar give each character the same id"""
+    return sorted(grammar.phone_char_mappings)
+
+
+def unknown_phones(lexicon, grammar):
+    """Characters of a lexicon's inventory that are not phones of grammar"""
+    return [char for char in lexicon.inventory if char not in grammar.phone_char_mappings]
+
+
+class BinaryLexicon(object):
+    """Read-only view of a binary lexicon through mmap. Words are looked up on demand,
+    so a lexicon of any size opens at once and is never held in memory as Python objects.
+    Layout: header, phone ids of all words back to back (1 or 2 bytes each), padding to 4 bytes,
+    word offsets into the ids (words + 1 of them, 4 bytes each), then the inventory:
+    a count and each character's UTF-8 bytes with their length. An id is a position in the inventory"""
+
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self.id_size, self.words, self.total, self.offsets_at, inventory_at = \
+                HEADER.unpack_from(self.map, 0)
+        except (ValueError, struct.error, mmap.error):
+            self.file.close()
+            raise ValueError("%s is not a binary lexicon" % filename)
+        if magic != MAGIC or version != VERSION or self.id_size not in ID_CODES:
+            self.close()
+            raise ValueError("%s is not a version %d binary lexicon" % (filename, VERSION))
+        self.id_code = ID_CODES[self.id_size]
+        count, = LENGTH.unpack_from(self.map, inventory_at)
+        position = inventory_at + LENGTH.size
+        self.inventory = []
+        for i in range(count):
+            length, = CHAR_LENGTH.unpack_from(self.map, position)
+            position += CHAR_LENGTH.size
+            self.inventory.append(self.map[position:position + length].decode("utf-8"))
+            position += length
+
+    def __len__(self):
+        return self.words
+
+    def ids(self, i):
+        """Tuple of the phone ids of word i"""
+        start, end = struct.unpack_from("<2I", self.map, self.offsets_at + i*OFFSET.size)
+        return struct.unpack_from("<%d%s" % (end - start, self.id_code), self.map, HEADER.size + start*self.id_size)
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.words:
+            raise IndexError("word %d of %d" % (i, self.words))
+        return self.ids(i)
+
+    def __iter__(self):
+        for i in xrange(self.words):
+            yield self.ids(i)
+
+    def word(self, i):
+        """Word i as text"""
+        return u"".join(self.inventory[id] for id in self[i])
+
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BinaryLexiconWriter(object):
+    """Write words to a binary lexicon one at a time. Characters missing from the inventory
+    it starts with are added to the end of it, up to what ids of id_size bytes can number"""
+
+    def __init__(self, filename, inventory=(), id_size=2):
+        self.filename = filename
+        self.out = open(filename, "wb")
+        self.out.write("\0"*HEADER.size)
+        self.inventory = list(inventory)
+        self.ids = dict((char, i) for i, char in enumerate(self.inventory))
+        self.id_size = id_size
+        self.id_code = ID_CODES[id_size]
+        # offsets of the words written so far, kept as machine integers rather than Python objects
+        self.offsets = array("L", [0])
+        self.total = 0
+
+    def id(self, char):
+        id = self.ids.get(char)
+        if id is None:
+            if len(self.inventory) >= 1 << (8*self.id_size):
+                raise ValueError("too many distinct characters for a binary lexicon")
+            id = self.ids[char] = len(self.inventory)
+            self.inventory.append(char)
+        return id
+
+    def write(self, word):
+        """Add a word, given as unicode text"""
+        self.write_ids([self.id(char) for char in word])
+
+    def write_ids(self, ids):
+        self.out.write(struct.pack("<%d%s" % (len(ids), self.id_code), *ids))
+        self.total += len(ids)
+        if self.total >= 1 << (8*OFFSET.size):
+            raise ValueError("too many phones for a binary lexicon")
+        self.offsets.append(self.total)
+
+    def close(self):
+        """Write the offsets table, inventory and header"""
+        self.out.write("\0"*(-self.out.tell() % OFFSET.size))
+        offsets_at = self.out.tell()
+        for start in xrange(0, len(self.offsets), 1 << 16):
+            chunk = self.offsets[start:start + (1 << 16)]
+            self.out.write(struct.pack("<%dI" % len(chunk), *chunk))
+        inventory_at = self.out.tell()
+        self.out.write(LENGTH.pack(len(self.inventory)))
+        for char in self.inventory:
+            encoded = char.encode("utf-8")
+            self.out.write(CHAR_LENGTH.pack(len(encoded)) + encoded)
+        self.out.seek(0)
+        self.out.write(HEADER.pack(MAGIC, VERSION, self.id_size, len(self.offsets) - 1, self.total, offsets_at, inventory_at))
+        self.out.close()
+
+
+def convert(grammar, source, filename):
+    """Write the lines of a text input file (or "-" for stdin) to a binary lexicon for grammar.
+    Spaces are dropped, as deriving a line drops them. Returns the number of words"""
+    inventory = input_inventory(grammar)
+    writer = BinaryLexiconWriter(filename, inventory, 1 if len(inventory) <= 1 << 8 else 2)
+    known = len(writer.inventory)
+    try:
+        for number, line in enumerate(read_lines(source)):
+            writer.write(re.sub(" ", "", line).decode("utf-8"))
+            if len(writer.inventory) > known:
+                raise ValueError(u"line %d: %s is not a phone of the grammar" % (number + 1, writer.inventory[known]))
+    finally:
+        writer.close()
+    return len(writer.offsets) - 1
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Convert input lines to a binary lexicon, or print one as text")
+    parser.add_argument("source", help="text file of URs (- for stdin), or with --decode a binary lexicon")
+    parser.add_argument("target", nargs="?", help="binary lexicon file to write")
+    parser.add_argument("--config", help="grammar config file whose phones the lexicon is written with")
+    parser.add_argument("--decode", action="store_true", help="print the words of a binary lexicon one per line")
+    parser.add_argument("--no-grammar-cache", action="store_true",
+                        help="parse the config file instead of loading it from its .cache file")
+    options = parser.parse_args(args)
+    if options.decode:
+        with BinaryLexicon(options.source) as lexicon:
+            # lines are joined the way read_lines splits them, so decoding gives back the converted text
+            for i in xrange(len(lexicon)):
+                sys.stdout.write(("\n" if i else "") + lexicon.word(i).encode("utf-8"))
+        return
+    if not options.config or not options.target:
+        parser.error("converting needs --config and a target file")
+    from GlobalGrammar import load_grammar
+    try:
+        words = convert(load_grammar(options.config, not options.no_grammar_cache), options.source, options.target)
+    except ValueError as e:
+        os.remove(options.target)
+        sys.exit(unicode(e).encode("utf-8"))
+    sys.stderr.write("%d words written to %s\n" % (words, options.target))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
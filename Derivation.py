@@ -0,0 +1,25 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+class Derivation(object):
+    """Record of one word's path through the grammar.
+    steps holds (rule block name, form after the block) with None as the form when the block did not apply,
+    or is None itself when the derivation was made without a trace.
+    changed holds the positions of the rule blocks that applied"""
+
+    __slots__ = ("ur", "steps", "sr", "changed")
+
+    def __init__(self, ur, steps, sr, changed=None):
+        self.ur = ur
+        self.steps = steps
+        self.sr = sr
+        if changed is None:
+            changed = tuple(block for block, (name, form) in enumerate(steps) if form is not None)
+        self.changed = changed
+
+    def __getstate__(self):
+        return self.ur, self.steps, self.sr, self.changed
+
+    def __setstate__(self, state):
+        self.ur, self.steps, self.sr, self.changed = state
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import io
+import itertools
+import json
+import sys
+
+FORMATS = ["table", "tsv", "jsonl", "sr", "lexicon"]
+
+
+def read_lines(source):
+    """Lazily yield input lines from a file name, an open file, or "-" for stdin.
+    Lines are split exactly as read().split("\\n") splits them"""
+    if source == "-":
+        inputfile = sys.stdin
+    elif isinstance(source, basestring):
+        inputfile = open(source, "r")
+    else:
+        inputfile = source
+    try:
+        line = ""
+        for line in inputfile:
+            yield line[:-1] if line.endswith("\n") else line
+        if not line or line.endswith("\n"):
+            yield ""
+    finally:
+        if inputfile is not source and inputfile is not sys.stdin:
+            inputfile.close()
+
+
+def derivation_record(derivation, trace=True):
+    """Derivation as a dictionary for JSON, with the forms after each rule block if trace"""
+    record = OrderedDict([("ur", derivation.ur)])
+    if trace and derivation.steps is not None:
+        record["steps"] = [[name.strip(), form] for name, form in derivation.steps]
+    record["sr"] = derivation.sr
+    return record
+
+
+def select_derivations(executor, URstrs, trace=True, changed_by=None, tracer=None):
+    """Derivations of input lines, in input order. With changed_by (rule block positions) only those
+    of words one of those blocks changed: every word is derived without a trace first, and only
+    the words kept are traced, by tracer (default executor)"""
+    if not changed_by:
+        for derivation in executor.derive_all(URstrs, trace):
+            yield derivation
+        return
+    tracer = tracer or executor
+    URstrs, again = itertools.tee(URstrs)
+    for URstr, derivation in itertools.izip(again, executor.derive_all(URstrs, False)):
+        if changed_by.intersection(derivation.changed):
+            yield tracer.derive(URstr) if trace else derivation
+
+
+class DerivationWriter(object):
+    """Write derivations incrementally through a buffer, as the readable table,
+    TSV (UR, form after each rule block, SR; empty where a block did not apply),
+    JSON Lines, TSV of just UR and SR (sr), or the SRs as a BinaryLexicon (lexicon).
+    A lexicon is written with inventory (the grammar's input_inventory) and word breaks as #,
+    so it reads back the same as a lexicon converted from text"""
+
+    def __init__(self, blocks, output=None, format="table", inventory=(), buffer_size=1 << 16):
+        if format not in FORMATS:
+            raise ValueError("Unknown output format %s, expected one of %s" % (format, ", ".join(FORMATS)))
+        self.blocks = blocks
+        self.format = format
+        # whether the format shows the forms after each rule block
+        self.trace = format not in ("sr", "lexicon")
+        if format == "lexicon":
+            if output is None or output == "-":
+                raise ValueError("lexicon output needs an output file")
+            from BinaryLexicon import BinaryLexiconWriter
+            self.out = BinaryLexiconWriter(output, inventory, 1 if len(inventory) <= 1 << 8 else 2)
+        elif output is None or output == "-":
+            sys.stdout.flush()
+            self.out = io.open(sys.stdout.fileno(), "w", buffering=buffer_size, encoding="utf-8", newline="\n", closefd=False)
+        else:
+            self.out = io.open(output, "w", buffering=buffer_size, encoding="utf-8", newline="\n")
+
+    def write_header(self):
+        if self.format == "table":
+            for name, rules in self.blocks:
+                self.out.write(name.strip() + u":\n")
+                for rule in rules:
+                    self.out.write(u"\t" + rule.rule_str + u"\n")
+            self.out.write(u"\n---\n---\n\n")
+        elif self.format == "tsv":
+            self.out.write(u"\t".join([u"UR"] + [name.strip() for name, rules in self.blocks] + [u"SR"]) + u"\n")
+
+    def write(self, derivation):
+        if self.format == "table":
+            lens = len(self.blocks[0][0])
+            lines = [u"UR".ljust(lens) + u"     /" + derivation.ur + u"/"]
+            for name, form in derivation.steps:
+                lines.append(name + u"      " + (form if form is not None else u"-"))
+            lines.append(u"SR".ljust(lens) + u"     [" + derivation.sr + u"]")
+            self.out.write(u"\n".join(lines) + u"\n\n---\n\n")
+        elif self.format == "tsv":
+            forms = [form if form is not None else u"" for name, form in derivation.steps]
+            self.out.write(u"\t".join([derivation.ur] + forms + [derivation.sr]) + u"\n")
+        elif self.format == "sr":
+            self.out.write(derivation.ur + u"\t" + derivation.sr + u"\n")
+        elif self.format == "lexicon":
+            self.out.write(derivation.sr.replace(u" ", u"#"))
+        else:
+            self.out.write(unicode(json.dumps(derivation_record(derivation), ensure_ascii=False)) + u"\n")
+
+    def close(self):
+        self.out.close()
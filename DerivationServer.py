@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import BaseHTTPServer
+from collections import deque
+import json
+import os
+import Queue
+import SocketServer
+import sys
+import threading
+import time
+from Executor import *
+from GlobalGrammar import *
+
+
+class PendingRequest(object):
+    """URs from one client request, waiting for their derivations"""
+
+    def __init__(self, URstrs, trace=True):
+        self.URstrs = URstrs
+        self.trace = trace
+        self.derivations = None
+        self.error = None
+        self.received = time.time()
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent requests for one grammar into batches.
+    A single thread owns the executor, so its caches never need locking.
+    A batch is sent off as soon as it holds max_batch URs or its oldest request has waited max_wait seconds"""
+
+    def __init__(self, executor, max_batch=256, max_wait=0.005, window=10000):
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.words = 0
+        self.batches = 0
+        self.busy = 0.0
+        # latencies of the most recent requests
+        self.latencies = deque(maxlen=window)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def derive(self, URstrs, trace=True):
+        """Derivations of URstrs, blocking until their batch has run.
+        Forms after each rule block are only rendered for batches where some request wants them"""
+        request = PendingRequest(URstrs, trace)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.derivations
+
+    def next_batch(self):
+        """Wait for a request, then gather more until the batch is full or the first has waited long enough"""
+        batch = [self.queue.get()]
+        size = len(batch[0].URstrs)
+        deadline = batch[0].received + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.URstrs)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            URstrs = [URstr for request in batch for URstr in request.URstrs]
+            trace = any(request.trace for request in batch)
+            began = time.time()
+            try:
+                derivations = list(self.executor.derive_all(URstrs, trace))
+            except Exception:
+                # derive each request on its own, so only the requests that fail get an error
+                derivations = None
+            if derivations is not None:
+                start = 0
+                for request in batch:
+                    request.derivations = derivations[start:start + len(request.URstrs)]
+                    start += len(request.URstrs)
+            else:
+                for request in batch:
+                    try:
+                        request.derivations = list(self.executor.derive_all(request.URstrs, trace))
+                    except Exception as e:
+                        request.error = e
+            finished = time.time()
+            with self.lock:
+                self.requests += len(batch)
+                self.words += len(URstrs)
+                self.batches += 1
+                self.busy += finished - began
+                self.latencies.extend(finished - request.received for request in batch)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        """Throughput and request latency (in milliseconds, over recent requests)"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            uptime = time.time() - self.started
+            stats = {"requests": self.requests,
+                     "words": self.words,
+                     "batches": self.batches,
+                     "mean_batch_size": float(self.words)/self.batches if self.batches else 0.0,
+                     "words_per_second": self.words/uptime if uptime else 0.0,
+                     "words_per_busy_second": self.words/self.busy if self.busy else 0.0,
+                     "uptime": uptime}
+        if latencies:
+            stats["latency_ms"] = {"mean": 1000*sum(latencies)/len(latencies),
+                                   "p50": 1000*latencies[len(latencies)//2],
+                                   "p95": 1000*latencies[min(len(latencies) - 1, int(len(latencies)*0.95))],
+                                   "max": 1000*latencies[-1]}
+        stats["caches"] = self.executor.cache_stats()
+        return stats
+
+
+class DerivationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST /derive with {"grammar": name, "urs": [...], "trace": false} (or "ur" for a single word),
+    GET /stats for throughput and latency per grammar, GET /grammars for the loaded grammar names"""
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.reply(200, dict((name, batcher.stats()) for name, batcher in self.server.batchers.items()))
+        elif self.path == "/grammars":
+            self.reply(200, sorted(self.server.batchers))
+        else:
+            self.reply(404, {"error": "unknown path %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/derive":
+            self.reply(404, {"error": "unknown path %s" % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader("content-length", 0))))
+            name = request.get("grammar")
+            if name is None and len(self.server.batchers) == 1:
+                name = self.server.batchers.keys()[0]
+            if name not in self.server.batchers:
+                raise ValueError("unknown grammar %s" % name)
+            if "ur" in request:
+                URstrs = [request["ur"]]
+            else:
+                URstrs = request["urs"]
+            if not isinstance(URstrs, list) or not all(isinstance(URstr, basestring) for URstr in URstrs):
+                raise ValueError("urs must be a list of strings and ur a string")
+            chars = self.server.batchers[name].executor.grammar.phone_char_mappings
+            for URstr in URstrs:
+                unknown = set(URstr.replace(" ", "")).difference(chars)
+                if unknown:
+                    raise ValueError(u"%s is not a phone of the grammar" % u", ".join(sorted(unknown)))
+            URstrs = [URstr.encode("utf-8") for URstr in URstrs]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.reply(400, {"error": u"bad request: %s" % e})
+            return
+        trace = bool(request.get("trace", False))
+        try:
+            derivations = self.server.batchers[name].derive(URstrs, trace)
+        except Exception as e:
+            self.reply(500, {"error": "%s: %s" % (type(e).__name__, e)})
+            return
+        self.reply(200, {"grammar": name,
+                         "results": [derivation_record(derivation, trace) for derivation in derivations]})
+
+    def reply(self, status, body):
+        data = json.dumps(body, ensure_ascii=False)
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return self.server.server_address
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class DerivationServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server keeping parsed grammars loaded between requests"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, batchers, quiet=False):
+        self.batchers = batchers
+        self.quiet = quiet
+        BaseHTTPServer.HTTPServer.__init__(self, address, DerivationHandler)
+
+
+class UnixDerivationServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """DerivationServer listening on a unix socket"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, path, batchers, quiet=False):
+        self.batchers = batchers
+        self.quiet = quiet
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, DerivationHandler)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Serve derivations over HTTP from grammars kept in memory")
+    parser.add_argument("grammars", nargs="+", metavar="[NAME=]CONFIG",
+                        help="grammar config files to load, named by their file name unless NAME is given")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--socket", help="unix socket to listen on instead of a port")
+    parser.add_argument("--engine", choices=["executor", "batch"], default="executor",
+                        help="executor applies rules word by word, batch applies each rule to many words at once with numpy")
+    parser.add_argument("--max-batch", type=int, default=256, help="URs to gather into one batch")
+    parser.add_argument("--max-wait", type=float, default=5,
+                        help="milliseconds a request may wait for others to join its batch")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="derivations to remember per grammar, 0 to turn memoization off")
+    parser.add_argument("--no-grammar-cache", action="store_true",
+                        help="parse the config files instead of loading them from their .cache files")
+    parser.add_argument("--quiet", action="store_true", help="do not log requests")
+    options = parser.parse_args(args)
+    batchers = {}
+    for spec in options.grammars:
+        if "=" in spec:
+            name, config = spec.split("=", 1)
+        else:
+            name, config = os.path.splitext(os.path.basename(spec))[0], spec
+        grammar = load_grammar(config, not options.no_grammar_cache)
+        if options.engine == "batch":
+            from BatchExecutor import BatchExecutor
+            executor = BatchExecutor(grammar, options.max_batch)
+        else:
+            executor = Executor(grammar, options.cache_size)
+        batchers[name] = MicroBatcher(executor, options.max_batch, options.max_wait/1000.0)
+    if options.socket:
+        server = UnixDerivationServer(options.socket, batchers, options.quiet)
+    else:
+        server = DerivationServer((options.host, options.port), batchers, options.quiet)
+    sys.stderr.write("serving %s on %s\n" % (", ".join(sorted(batchers)), server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.socket and os.path.exists(options.socket):
+            os.remove(options.socket)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from Benchmark import generate_grammar, generate_lexicon, SCALES
+from DerivationIO import read_lines
+from Executor import *
+from GlobalGrammar import *
+
+# fuzzed grammar and lexicon settings, each checked with every seed:
+# few features and phonemes, so renderings often tie between phones, and rules on the word boundary,
+# and short environments counting syllables, with the word boundary often made syllabic or deleted,
+# and the same with half the rules changing the word boundary, which is one phone on both sides
+FUZZ = OrderedDict([
+    ("ties", dict(SCALES["small"], features=3, phonemes=4, words=200, break_share=0.2)),
+    ("syllables", dict(SCALES["small"], features=8, phonemes=6, rules=30, env_length=1, syll_share=0.3,
+                       resize_share=0.2, words=200, break_share=0.15)),
+    ("boundary", dict(SCALES["small"], features=8, phonemes=6, rules=30, env_length=1, syll_share=0.3,
+                      resize_share=0.2, words=200, break_share=0.5)),
+])
+
+
+def derivations(executor, words):
+    """(UR, forms after each block, SR) of each word"""
+    return [(d.ur, tuple(form for name, form in d.steps), d.sr) for d in executor.derive_all(words)]
+
+
+def mismatches(words, expected, found):
+    """(word, expected, found) for the words whose derivations differ"""
+    return [(word, a, b) for word, a, b in zip(words, expected, found) if a != b]
+
+
+def check_grammar_cache(config, words, workdir):
+    """Derive words with the grammar parsed from config and with it loaded back from a cache file"""
+    cache_file = os.path.join(workdir, os.path.basename(config) + ".cache")
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    load_grammar(config, True, cache_file)
+    expected = derivations(Executor(GlobalGrammar(config), 0), words)
+    return mismatches(words, expected, derivations(Executor(load_grammar(config, True, cache_file), 0), words))
+
+
+def check_batch(config, words, workdir):
+    """Derive words with Executor and with BatchExecutor"""
+    from BatchExecutor import BatchExecutor
+    grammar = GlobalGrammar(config)
+    expected = derivations(Executor(grammar, 0), words)
+    return mismatches(words, expected, derivations(BatchExecutor(grammar, 64), words))
+
+
+def check_optimize(config, words, workdir):
+    """Derive words applying each rule in turn and applying independent rules fused"""
+    grammar = GlobalGrammar(config)
+    expected = derivations(Executor(grammar, 0), words)
+    return mismatches(words, expected, derivations(Executor(grammar, 0, optimize=True), words))
+
+
+CHECKS = OrderedDict([("grammar_cache", check_grammar_cache), ("batch", check_batch), ("optimize", check_optimize)])
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Derive fuzzed lexicons through fuzzed grammars in ways that must agree, "
+                                                 "and report the words where they do not")
+    parser.add_argument("checks", nargs="*", default=list(CHECKS), help="checks to run: %s" % ", ".join(CHECKS))
+    for param, value in FUZZ["ties"].items():
+        parser.add_argument("--" + param.replace("_", "-"), type=type(value),
+                            help="override %s for every setting" % param.replace("_", " "))
+    parser.add_argument("--settings", nargs="+", default=list(FUZZ), help="fuzz settings to use: %s" % ", ".join(FUZZ))
+    parser.add_argument("--seeds", type=int, default=20, help="fuzzed grammars to check per setting, seeded 0 up")
+    parser.add_argument("--keep", help="directory to write fuzzed grammars and lexicons to instead of a temporary one")
+    options = parser.parse_args(args)
+    for name in options.checks:
+        if name not in CHECKS:
+            parser.error("unknown check %s" % name)
+    for setting in options.settings:
+        if setting not in FUZZ:
+            parser.error("unknown setting %s" % setting)
+    workdir = options.keep or tempfile.mkdtemp(prefix="differential")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    failed = 0
+    try:
+        for setting in options.settings:
+            params = dict(FUZZ[setting])
+            for param in params:
+                if getattr(options, param) is not None:
+                    params[param] = getattr(options, param)
+            for seed in range(options.seeds):
+                config = os.path.join(workdir, "%s_config_%d.txt" % (setting, seed))
+                inputs = os.path.join(workdir, "%s_inputs_%d.txt" % (setting, seed))
+                inventory = generate_grammar(config, params["features"], params["phonemes"], params["rules"],
+                                             params["env_length"], params["syll_share"], params["resize_share"], seed,
+                                             params["break_share"])
+                generate_lexicon(inputs, inventory, params["words"], params["word_length"], seed)
+                words = [line for line in read_lines(inputs) if line.strip()]
+                for name in options.checks:
+                    found = CHECKS[name](config, words, workdir)
+                    if found:
+                        failed += 1
+                        word, expected, got = found[0]
+                        sys.stdout.write(("%s, %s seed %d: %d words differ, first %s: %r != %r\n" %
+                                          (name, setting, seed, len(found), word, expected, got)).encode("utf-8"))
+    finally:
+        if not options.keep:
+            shutil.rmtree(workdir)
+    sys.stdout.write("%d of %d checks failed\n" % (failed, options.seeds*len(options.settings)*len(options.checks)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
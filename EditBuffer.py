@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+
+def insert_at_sites(items, sites):
+    """New list of items with one new item per (position, offset, item) site, sorted by position.
+    Same as calling list.insert(position + offset, item) for each site in turn on a copy,
+    where positions are those before any insertion (so each insertion lands one place earlier,
+    relative to the original items, than the one before it), but in a single pass"""
+    out = []
+    # the inserted items and original items after out, which later insertions can still move
+    pending = deque()
+    k = 0
+    for position, offset, item in sites:
+        target = position + offset
+        # nothing before target moves again, since later targets are never smaller
+        while len(out) < target and (pending or k < len(items)):
+            if pending:
+                out.append(pending.popleft())
+            else:
+                out.append(items[k])
+                k += 1
+        pending.appendleft(item)
+    out.extend(pending)
+    out.extend(items[k:])
+    return out
+
+
+class EditBuffer(object):
+    """Deletions and insertions a rule makes while scanning a word, applied in one linear rebuild
+    afterwards so positions stay those of the scanned word. Phones are marked by identity,
+    so marking the shared padding at any of its positions marks all of them"""
+
+    def __init__(self, word):
+        self.word = word
+        self.deleted = set()
+        # phones to insert a new phone after, by id of the marked phone
+        self.marked = {}
+        self.deletions = 0
+        self.insertions = 0
+
+    def delete(self, index):
+        self.deleted.add(id(self.word[index]))
+
+    def insert_after(self, index, phone):
+        """Insert phone after the phone at index, or after the one following it if that is a word break"""
+        self.marked.setdefault(id(self.word[index]), phone)
+
+    def apply(self):
+        """The word after the edits. Phones either side of a deleted one are marked as touched"""
+        word = self.word
+        if self.deleted:
+            kept = []
+            for i, phone in enumerate(word):
+                if id(phone) in self.deleted:
+                    self.deletions += 1
+                    if i > 0:
+                        word[i-1].touched = True
+                    if i+1 < len(word):
+                        word[i+1].touched = True
+                else:
+                    kept.append(phone)
+            word = kept
+        if self.marked:
+            sites = []
+            for i, phone in enumerate(word):
+                inserted = self.marked.pop(id(phone), None)
+                if inserted is not None:
+                    sites.append((i, 2 if phone.name == "#" else 1, inserted))
+            self.insertions = len(sites)
+            word = insert_at_sites(word, sites)
+        return word
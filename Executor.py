@@ -7,49 +7,90 @@ import re
 from collections import OrderedDict
 from itertools import groupby
 import sys
+import time
 from GlobalGrammar import *
+from Derivation import *
+from LRUCache import *
+from DerivationIO import *
+from PositionIndex import *
+from EditBuffer import *
+from BinaryLexicon import *
+
+# form of a block that applied, when it was not rendered
+UNRENDERED = object()
 
 class Executor():
     """Put words through phonological grammar to get their surface representations"""
 
-    def __init__(self, grammar):
+    def __init__(self, grammar, cache_size=10000, optimize=False, block_cache_size=0):
         self.grammar = grammar
+        # derivations by input string, and rule block results by block and incoming word.
+        # Words rarely reach a block in the same state twice, so block results are only
+        # remembered when asked for, as keying on the whole word costs more than it saves
+        self.derivations = LRUCache(cache_size)
+        self.block_results = LRUCache(block_cache_size)
+        # character each bundle is rendered as
+        self.chars = {}
+        # (features, character) of each phone id of the binary lexicon being read, if any
+        self.id_phones = None
+        self.break_mask = feature_mask(grammar.features, "break")
+        syll_mask = feature_mask(grammar.features, "syll")
+        self.syllabic = FeatureBundle(syll_mask, syll_mask)
+        # bundles of the syllable templates, and whether phones with a bundle can be in a syllable
+        self.template_bundles = set(grammar.phones[char] for template in
+                                    grammar.syllables["onsets"] | grammar.syllables["codas"] for char in template)
+        self.joins_syllables = {}
+        # onset templates (bundles, length not counting boundaries) that can wrap around the start, longest first
+        self.wrapped_onsets = [([grammar.phones[char] for char in onset], self.clean_len(onset))
+                               for onset in grammar.syllables["onsets"] if self.clean_len(onset)]
+        self.wrapped_onsets.sort(key=lambda onset: -onset[1])
+        # Profiler collecting per-rule counts and timings, if any
+        self.profiler = None
+        # with optimize, RuleAnalysis of the grammar and the steps it plans per block
+        self.analysis = None
+        self.plan = None
+        if optimize:
+            from RuleAnalysis import RuleAnalysis
+            self.analysis = RuleAnalysis(grammar)
+            self.plan = self.analysis.plan()
 
     def getPhoneUR(self, char):        
         """Get Phone matching character"""
-        return Phone(copy(self.grammar.phones[self.grammar.phone_char_mappings[char]]), char, False)
+        return Phone(self.grammar.phones[self.grammar.phone_char_mappings[char]], char, False)
 
     def getUR(self, flat_word):
-        """Get underlying representation of word in Phones"""
+        """Get underlying representation of word in Phones.
+        The padding at both ends is a single Phone repeated, and rules see it as one phone:
+        a change to it shows at every padding position, and an insertion after it lands after the
+        leading padding. Derivations depend on this, so it must stay shared"""
         center = [self.getPhoneUR(char) for char in flat_word.decode("utf-8")]
-        ends = [Phone(copy(self.grammar.phones[self.grammar.phone_char_mappings["#"]]), "#", False)]*PADDING*2
+        ends = [Phone(self.grammar.phones[self.grammar.phone_char_mappings["#"]], "#", False)]*PADDING*2
         ends[PADDING:PADDING] = center
         return ends
 
-    def segs_match(self, segments, sylls, piv_index, word, syll_aware, is_prefix, offsets = None):
-        """try matching environment of a segment
-        may be syllable-aware (syllabification) or not"""
-        if is_prefix:
-            potential = [phone.features for phone in word[piv_index-len(segments):]]
-            potential_sylls = sylls[piv_index-len(segments):]
-        else:
-            potential = [phone.features for phone in word[piv_index+1:]]
-            potential_sylls = sylls[piv_index+1:]
-        if not potential:
-            return False
-        for i,feats in enumerate(segments):
-            match = False
-            for seg in segments[i]:
- #               if offsets:
-#                    print len(segments),potential[i], seg
-#                    print is_prefix, piv_index, len(segments), ".", len(potential), len(potential_sylls), len(offsets), len(sylls)
-                if match_features(potential[i], seg) and \
-                        (not syll_aware or (potential_sylls[i] < 0 and (not offsets or seg['break'] == TRUE)) or \
-                             (offsets and offsets[i] + sylls[piv_index] == potential_sylls[i])):
-                    match = True
-            if not match:
-                return False
-        return True
+    def read_lexicon(self, lexicon):
+        """Prepare to derive words given as phone id tuples of a BinaryLexicon"""
+        unknown = unknown_phones(lexicon, self.grammar)
+        if unknown:
+            raise ValueError(u"lexicon has phones the grammar does not: %s" % u" ".join(unknown))
+        self.id_phones = [(self.grammar.phones[self.grammar.phone_char_mappings[char]], char)
+                          for char in lexicon.inventory]
+
+    def getUR_ids(self, ids):
+        """Get underlying representation in Phones of a word of phone ids"""
+        id_phones = self.id_phones
+        center = [Phone(id_phones[id][0], id_phones[id][1], False) for id in ids]
+        ends = [Phone(self.grammar.phones[self.grammar.phone_char_mappings["#"]], "#", False)]*PADDING*2
+        ends[PADDING:PADDING] = center
+        return ends
+
+    def read_inputs(self, source):
+        """Words of a binary lexicon file (as phone id tuples) or lines of any other input"""
+        if is_lexicon(source):
+            lexicon = BinaryLexicon(source)
+            self.read_lexicon(lexicon)
+            return iter(lexicon)
+        return read_lines(source)
 
     def clean_len(self, segment):
         """Find the length of word minus padding"""
@@ -61,113 +102,187 @@ class Executor():
         moras = [False]*len(word)
         count = 0
         for i, phone in enumerate(word):
-            if match_features(phone.features, {"syll":TRUE}):
+            if match_features(phone.features, self.syllabic):
                 sylls[i] = count
                 moras[i] = True
                 count += 1                
         nuclei = [i for i, mora in enumerate(moras) if mora == True]
         # find onsets
         for nucleus in nuclei:
-            matched = ''
-            for onset in self.grammar.syllables["onsets"]:
-                if self.segs_match([[self.grammar.phones[phone]] for phone in onset],sylls,nucleus,word,True,True):
-                    if self.clean_len(onset) > self.clean_len(matched):
-                        matched = onset
-            for i in range(nucleus-self.clean_len(matched),nucleus):
-                sylls[i] = sylls[nucleus]
+            self.add_onset(word, sylls, nucleus)
         # find codas
         for nucleus in nuclei:
-            matched = ''
-            for coda in self.grammar.syllables["codas"]:
-                if self.segs_match([[self.grammar.phones[phone]] for phone in coda],sylls,nucleus,word,True,False):
-                    if self.clean_len(coda) > self.clean_len(matched):
-                        matched = coda
-            for i in range(nucleus+1,nucleus+self.clean_len(matched)+1):
-                moras[i] = True
-                sylls[i] = sylls[nucleus]
+            self.add_coda(word, sylls, moras, nucleus)
         # apply findings
         for i, phone in enumerate(word):
             phone.syll = sylls[i]
             phone.mora = moras[i]
+            phone.touched = False
         return word
 
-    def match_env(self, rule, word, index):
-        """given location of a matching phone  and a rule, check if the phone is in the environment"""
-        if not rule.has_env():
-            return True
+    def add_onset(self, word, sylls, nucleus):
+        """Put the longest onset template matching before nucleus in its syllable"""
+        if nucleus == 0:
+            length = self.wrapped_onset(word, sylls)
+        else:
+            length = self.grammar.syllables["onset_trie"].longest(word, sylls, nucleus-1, -1)
+        for i in range(nucleus-length,nucleus):
+            sylls[i] = sylls[nucleus]
+
+    def wrapped_onset(self, word, sylls):
+        """Length of the longest onset template matching the last phones of the word, for a nucleus at its start.
+        Onsets reaching past the start of the word wrap around like a slice, as environments do in RuleMatcher,
+        and only for a nucleus at the very start does a wrapped template end within the word"""
+        n = len(word)
+        for bundles, length in self.wrapped_onsets:
+            start = n - len(bundles)
+            if start >= 0 and all(sylls[start+k] < 0 and match_features(word[start+k].features, bundle)
+                                  for k, bundle in enumerate(bundles)):
+                return length
+        return 0
+
+    def add_coda(self, word, sylls, moras, nucleus):
+        """Put the longest coda template matching after nucleus in its syllable"""
+        length = self.grammar.syllables["coda_trie"].longest(word, sylls, nucleus+1, 1)
+        for i in range(nucleus+1,nucleus+length+1):
+            moras[i] = True
+            sylls[i] = sylls[nucleus]
+
+    def may_join_syllable(self, features):
+        """Whether phones with these features can be a nucleus or part of an onset or coda"""
+        joins = self.joins_syllables.get(features)
+        if joins is None:
+            joins = self.joins_syllables[features] = match_features(features, self.syllabic) or \
+                any(match_features(features, bundle) for bundle in self.template_bundles)
+        return joins
+
+    def resyllabify(self, word):
+        """Syllabify a word again, redoing onsets and codas only between
+        the nuclei around phones touched since it was last syllabified"""
+        if not any(phone.touched for phone in word):
+            return word
+        # the padding is one Phone at both ends (see getUR) and holds a single syllable number,
+        # so where it may be in a syllable the numbers kept on the phones cannot be reused
+        padding = word[0]
+        if len(word) > 1 and padding is word[-1] and (padding.touched or self.may_join_syllable(padding.features)):
+            return self.syllabify(word)
+        nuclei = [i for i, phone in enumerate(word) if match_features(phone.features, self.syllabic)]
+        if self.wrapped_onsets and ((nuclei and nuclei[0] == 0) or word[0].touched):
+            # the onset of a nucleus at the start (now or before the word changed) is at the end of the word,
+            # far from any touched phone
+            return self.syllabify(word)
         sylls = [phone.syll for phone in word]
-        pre_index = index
-        post_index = index
-        if [None] in rule.seg_match:
-            pre_index += 1
-#            post_index -= 1
-        if not self.segs_match(rule.pre_env,sylls,pre_index,word,rule.pre_syll_aware,True,offsets=rule.pre_env_sylls):
-            return False
-        if not rule.post_env:            
-            return True
-        if self.segs_match(rule.post_env,sylls,post_index,word,rule.post_syll_aware,False,offsets=rule.post_env_sylls):
-            return True
-        return False
-    
-    def match_rule_seg(self, rule, seg):
-        """determine if this phone matches the rule"""
-        if [None] in rule.seg_match:
-            return True
-        for option in rule.seg_match:
-            if match_features(seg.features,option):
-                    return True
-        return False
+        moras = [phone.mora for phone in word]
+        # gap k holds the phones between nucleus k-1 and nucleus k
+        bounds = [-1] + nuclei + [len(word)]
+        dirty = set()
+        renumber = {}
+        for k, nucleus in enumerate(nuclei):
+            if word[nucleus].touched:
+                dirty.update([k, k+1])
+            else:
+                renumber[sylls[nucleus]] = k
+            sylls[nucleus] = k
+            moras[nucleus] = True
+        for k in range(len(bounds)-1):
+            gap = range(bounds[k]+1, bounds[k+1])
+            if k not in dirty and any(word[i].touched for i in gap):
+                dirty.add(k)
+            if k in dirty:
+                for i in gap:
+                    sylls[i] = -1
+                    moras[i] = False
+            else:
+                for i in gap:
+                    sylls[i] = renumber.get(sylls[i], -1)
+        for k in sorted(dirty):
+            if k < len(nuclei):
+                self.add_onset(word, sylls, nuclei[k])
+            if k > 0:
+                self.add_coda(word, sylls, moras, nuclei[k-1])
+        for i, phone in enumerate(word):
+            phone.syll = sylls[i]
+            phone.mora = moras[i]
+            phone.touched = False
+        return word
 
     def change_features(self,rule, seg): 
-        """change features of matched phone"""
-        if None in rule.seg_change: #mark this segment for deletion if this is a deletion rule
-            seg.to_delete = True
-            return
-        if [None] in rule.seg_match: #mark this for insertion if this is an insertion rule
-            seg.add_here = True
-            return
-        for feat in rule.seg_change.keys():
-            if rule.seg_change[feat] != UNDEF:
-                seg.features[feat] = rule.seg_change[feat]
-
-    def apply_rule(self, rule, word):
+        """change features of matched phone. Deletions and insertions go through an EditBuffer instead"""
+        # bundles are shared and never modified, the phone is pointed at the changed one
+        features = rule.matcher.change(seg.features)
+        if features is not seg.features:
+            seg.features = features
+            seg.touched = True
+
+    def apply_rule(self, rule, word, index=None, stats=None):
         """Apply ordered rule to word.
-        Only a few types of rules currently supported
-        no deletions or insertions
-        not all expressions of environments are permissible yet
-        no syllable-aware rule environments"""
+        With a PositionIndex of the word only positions whose phones can be the rule's target
+        are visited, and the index is kept up to date with feature changes.
+        With a RuleProfile as stats, what the rule did is counted in it.
+        Deletions and insertions are collected in an EditBuffer and made once the scan is done,
+        so the word is only rebuilt by rules that change its length"""
         changed = False
-        for i, phone in enumerate(word):
-            if self.match_rule_seg(rule,phone):
-                if self.match_env(rule,word,i):
+        positions = None
+        if index is not None:
+            positions = index.candidates(rule.matcher)
+            if not positions:
+                return word, changed
+        if stats is None:
+            scan = rule.matcher.scan(word, positions)
+        else:
+            scan = rule.matcher.scan_counted(word, positions, stats)
+        if rule.matcher.resizes:
+            edits = EditBuffer(word)
+            for i in scan:
+                changed = True
+                if rule.matcher.insertion:
+                    inserted = Phone(rule.insert_features, rule.insert_char, False)
+                    inserted.touched = True
+                    edits.insert_after(i, inserted)
+                else:
+                    edits.delete(i)
+            word = edits.apply()
+            if stats is not None:
+                stats.deletions += edits.deletions
+                stats.insertions += edits.insertions
+            return word, changed
+        for i in scan:
+            changed = True
+            features = word[i].features
+            self.change_features(rule,word[i])
+            if word[i].features != features:
+                if index is not None:
+                    index.move(i, features, word[i].features)
+                if stats is not None:
+                    stats.changes += 1
+        return word, changed
+
+    def apply_fused(self, rules, word, index=None):
+        """Apply rules that RuleAnalysis found independent in a single left to right pass,
+        every rule in turn at each position"""
+        changed = False
+        if index is not None:
+            positions = set()
+            for rule in rules:
+                positions.update(index.candidates(rule.matcher))
+            positions = sorted(positions)
+        else:
+            positions = xrange(len(word))
+        for i in positions:
+            phone = word[i]
+            for rule in rules:
+                matcher = rule.matcher
+                if matcher.match_seg(phone.features) and matcher.match_env(word, i):
                     changed = True
-                    self.change_features(rule,phone)
-        #filter out segments meant for deletion
-        word =  filter(lambda x: x.to_delete == False, word)
-        #Add new phones
-        for i, phone in list(enumerate(word)):
-            if phone.add_here:
-                phone.add_here = False
-                offset = 1
-                #for word-initial insert
-                if phone.name == "#":
-                    offset = 2
-                word.insert(i+offset, self.getPhoneUR(rule.seg_change_str.strip()))
-                    
+                    features = phone.features
+                    self.change_features(rule, phone)
+                    if index is not None and phone.features != features:
+                        index.move(i, features, phone.features)
         return word, changed
 
     def get_char_representation(self, seg):
         """Determine character representation of phone"""
-        char_rep = seg.features.__str__()
-        best = len(seg.features)
-        for phone in self.grammar.phones.keys():
-            errors = 0
-            for feat in self.grammar.phones[phone].keys():
-                if seg.features[feat] != self.grammar.phones[phone][feat]:
-                    errors += 1
-            if errors < best:
-                best = errors
-                char_rep = self.grammar.phone_char_mappings[phone]
+        char_rep = self.grammar.nearest_char(seg.features)
         if char_rep != "#":
             return char_rep
         else:
@@ -176,32 +291,131 @@ class Executor():
 
     def get_word_representation(self, word):
         """Output list of phones in readable format"""
-        return "".join([self.get_char_representation(seg) for seg in word]).strip()
-
-    def apply_to_inputs(self, filename):
-        with open(filename, "r") as inputfile:
-            URstrs = inputfile.read().split("\n")
-#            URstrs = [line.strip() for line in inputfile]
-        for name, rules in self.grammar.rules:
-            print name.strip() + ":"
+        chars = self.chars
+        for seg in word:
+            if seg.features not in chars:
+                chars[seg.features] = self.get_char_representation(seg)
+        return "".join([chars[seg.features] for seg in word]).strip()
+
+    def freeze(self, word):
+        """Immutable copy of a word. Positions holding the same Phone point at its first position"""
+        first = {}
+        return tuple((phone.features, phone.name, phone.syll, phone.mora, first.setdefault(id(phone), i))
+                     for i, phone in enumerate(word))
+
+    def thaw(self, frozen):
+        """New word from a frozen copy"""
+        word = []
+        for i, (features, name, syll, mora, same_as) in enumerate(frozen):
+            if same_as == i:
+                phone = Phone(features, name, False)
+                phone.syll = syll
+                phone.mora = mora
+            else:
+                phone = word[same_as]
+            word.append(phone)
+        return word
+
+    def apply_block(self, block, rules, phones, index=None, render=True):
+        """Apply every rule of a block to a syllabified word, then resyllabify it.
+        Returns the word, its form after the block (None if no rule applied, UNRENDERED
+        if one did but render is off) and the word's PositionIndex, which is None when it has to be rebuilt"""
+        profiler = self.profiler
+        if profiler is not None:
+            started = time.time()
+        if self.block_results.maxsize > 0:
+            key = (block, tuple((features, name == "#", same_as) for features, name, syll, mora, same_as in self.freeze(phones)))
+            cached = self.block_results.get(key)
+            if cached is not None:
+                phones = self.thaw(cached[0])
+                form = cached[1]
+                if form is UNRENDERED and render:
+                    # resyllabifying leaves features alone, so the word after the block renders the same
+                    form = self.get_word_representation(phones)
+                    self.block_results.put(key, (cached[0], form))
+                if profiler is not None:
+                    profiler.add_block(rules, time.time() - started, True)
+                return phones, form, None
+        updated = False
+        if index is None:
+            index = PositionIndex(phones)
+        if self.plan is not None and profiler is None:
+            for step in self.plan[block]:
+                if len(step) == 1:
+                    phones, updated_this_time = self.apply_rule(step[0], phones, index)
+                else:
+                    phones, updated_this_time = self.apply_fused(step, phones, index)
+                updated = updated or updated_this_time
+                if updated_this_time and step[0].matcher.resizes:
+                    index = PositionIndex(phones)
+        else:
             for rule in rules:
-                print "\t", rule.rule_str
-        print '\n---\n---\n'
-        for URstr in URstrs:
-            phones = self.syllabify(self.getUR(re.sub(" ", "", URstr)))
-            lens = len(self.grammar.rules[0][0])
-            print "UR".ljust(lens), "    /"+self.get_word_representation(phones)+"/"
-            for name, rules in self.grammar.rules:
-                updated = False
-                for rule in rules:
-                    phones, updated_this_time = self.apply_rule(rule,phones)
-                    updated = updated or updated_this_time
-                new_phones = self.get_word_representation(phones)
-                if updated:
-                    print rule.rule_name, "    ", new_phones
+                if profiler is None:
+                    phones, updated_this_time = self.apply_rule(rule,phones,index)
                 else:
-                    print rule.rule_name, "    ", "-"
-                phones = self.syllabify(phones)
-            print "SR".ljust(lens), "    ["+self.get_word_representation(phones)+"]"
-            print '\n---\n'
+                    phones, updated_this_time = profiler.apply_rule(self, rule, phones, index)
+                updated = updated or updated_this_time
+                if updated_this_time and rule.matcher.resizes:
+                    index = PositionIndex(phones)
+        if not updated:
+            form = None
+        elif render:
+            form = self.get_word_representation(phones)
+        else:
+            form = UNRENDERED
+        if profiler is None:
+            phones = self.resyllabify(phones)
+        else:
+            phones = profiler.time_stage("resyllabify", self.resyllabify, phones)
+        if self.block_results.maxsize > 0:
+            self.block_results.put(key, (self.freeze(phones), form))
+        if profiler is not None:
+            profiler.add_block(rules, time.time() - started, False)
+        return phones, form, index
+
+    def derive(self, URstr, trace=True):
+        """Put one input line, or a tuple of phone ids from a binary lexicon, through every rule block.
+        Without trace the forms after each block are not rendered, and the derivation has no steps"""
+        flat_word = URstr if isinstance(URstr, tuple) else re.sub(" ", "", URstr)
+        derivation = self.derivations.get(flat_word)
+        if derivation is not None and (derivation.steps is not None or not trace):
+            return derivation
+        phones = self.getUR_ids(flat_word) if isinstance(flat_word, tuple) else self.getUR(flat_word)
+        if self.profiler is None:
+            phones = self.syllabify(phones)
+        else:
+            phones = self.profiler.time_stage("syllabify", self.syllabify, phones)
+        ur = self.get_word_representation(phones)
+        steps = []
+        changed = []
+        index = None
+        for block, (name, rules) in enumerate(self.grammar.rules):
+            phones, form, index = self.apply_block(block, rules, phones, index, trace)
+            steps.append((name, form))
+            if form is not None:
+                changed.append(block)
+        derivation = Derivation(ur, steps if trace else None, self.get_word_representation(phones), tuple(changed))
+        self.derivations.put(flat_word, derivation)
+        return derivation
+
+    def cache_stats(self):
+        return {"derivations": self.derivations.stats(), "blocks": self.block_results.stats()}
+
+    def derive_all(self, URstrs, trace=True):
+        """Derivations of input lines, in input order"""
+        for URstr in URstrs:
+            yield self.derive(URstr, trace)
+
+    def derive_stream(self, source, trace=True):
+        """Generator of derivations for the lines of a file name, open file or "-" for stdin.
+        Lines are read as they are needed"""
+        return self.derive_all(read_lines(source), trace)
 
+    def apply_to_inputs(self, filename, output=None, format="table", changed_by=None):
+        """Derive every line of filename, writing results as they are produced.
+        With changed_by (rule block positions) only words one of those blocks changed are written"""
+        writer = DerivationWriter(self.grammar.rules, output, format, input_inventory(self.grammar))
+        writer.write_header()
+        for derivation in select_derivations(self, self.read_inputs(filename), writer.trace, changed_by):
+            writer.write(derivation)
+        writer.close()
@@ -3,11 +3,15 @@
 
 import codecs
 from copy import copy
+import cPickle
+import hashlib
+import os
 import re
 from collections import OrderedDict
 from itertools import groupby
 import sys
 from Rule import *
+from SyllableTrie import *
 
 TRUE = 1
 FALSE = 0
@@ -18,6 +22,9 @@ SYLL = "σ".decode("utf-8")
 
 
 PADDING = 2
+
+# bump whenever the pickled form of a parsed grammar changes
+GRAMMAR_CACHE_VERSION = 5
                     
 class GlobalGrammar():
     """Processes config file to represent phonological grammar"""
@@ -25,8 +32,12 @@ class GlobalGrammar():
     def __init__(self, filename):
         self.features = None
         self.phones = None
+        self.phone_order = None
+        self.phonemes = None
         self.syllables = None
         self.rules = None
+        self.char_index = None
+        self.nearest_chars = {}
         self.sections = self.section_file(filename)
 
 
@@ -38,7 +49,12 @@ class GlobalGrammar():
         sec_filter = lambda x, sec: filter(lambda y: sec in y, x)[0]
         self.features = self.read_features(sec_filter(full, "FEATURE"))
         self.phones = self.map_phones(sec_filter(full, "PHONEME"),sec_filter(full, "ABBREV"))
+        # phones are searched in the order the dict had when parsed, since one loaded from the cache
+        # may iterate in another order and searches break ties by that order
+        self.phone_order = self.phones.keys()
+        self.phonemes = self.read_phonemes(sec_filter(full, "PHONEME"))
         self.phone_char_mappings = self.map_phone_chars(sec_filter(full, "PHONEME"), sec_filter(full, "ABBREV"))
+        self.char_index = self.index_phone_chars()
         self.syllables = self.read_syllables(sec_filter(full, "SYLL"))
         self.rules = self.parse_rules(sec_filter(full, "RULE"))
         return full
@@ -50,12 +66,18 @@ class GlobalGrammar():
                            x and "FEATURE" not in x, feature_sec.split("\n"))]
 
     def map_phones(self, phone_sec, abbrev_sec):
-        """map phonemes, abbreviations, and word boundary (#) characters to dictionaries of binary feature values"""
+        """map phonemes, abbreviations, and word boundary (#) characters to bundles of binary feature values"""
         combined = phone_sec + abbrev_sec
         return {line.split(":")[0].split()[-1].strip() : get_features(self.features,line.split(":")[1].strip()) for line in 
                 filter(lambda x:
                            x and "ABBREV" not in x and "PHONE" not in x, combined.split("\n"))}        
 
+    def read_phonemes(self, phone_sec):
+        """Names of the phonemes (leaving out abbreviations) in the order they are listed"""
+        return [line.split(":")[0].split()[-1].strip() for line in
+                filter(lambda x:
+                           x and "PHONE" not in x and ":" in x, phone_sec.split("\n"))]
+
     def map_phone_chars(self, phone_sec, abbrev_sec):
         """Some phones are represented by 2+ characters. Map those to single characters as specified in config file"""
         combined = phone_sec + abbrev_sec
@@ -63,16 +85,64 @@ class GlobalGrammar():
                 filter(lambda x:
                             x and "ABBREV" not in x and "PHONE" not in x, combined.split("\n"))}        
 
+    def index_phone_chars(self):
+        """Reverse of phones: map each feature bundle to the character of the first phone that has it"""
+        index = {}
+        for phone in self.phone_order:
+            index.setdefault(self.phones[phone], self.phone_char_mappings[phone])
+        return index
+
+    def nearest_char(self, features):
+        """Character of the phone whose features differ from the bundle in the fewest places.
+        Exact matches come from the index, others are searched for once and remembered"""
+        if features in self.char_index:
+            return self.char_index[features]
+        if features not in self.nearest_chars:
+            char_rep = features.__str__()
+            best = len(self.features)
+            for phone in self.phone_order:
+                errors = feature_distance(features, self.phones[phone])
+                if errors < best:
+                    best = errors
+                    char_rep = self.phone_char_mappings[phone]
+            self.nearest_chars[features] = char_rep
+        return self.nearest_chars[features]
+
+    def closure(self, bundles, rules=None):
+        """Every bundle reachable from bundles through the feature changes of rules (default all rules).
+        Environments are ignored, so some of these bundles may never actually come about"""
+        if rules is None:
+            rules = [rule for name, block in self.rules for rule in block]
+        rules = [rule for rule in rules if not rule.matcher.resizes]
+        seen = set(bundles)
+        pending = list(seen)
+        while pending:
+            bundle = pending.pop()
+            for rule in rules:
+                if rule.matcher.triggered_by(bundle):
+                    changed = update_features(bundle, rule.seg_change)
+                    if changed not in seen:
+                        seen.add(changed)
+                        pending.append(changed)
+        return seen
+
     def read_syllables(self, syll_sec):
         """Read syllable formats, decompose into sets of nuclei (the vowel, probably), onsets (before the nucleus), and codas (after the nucleus)"""
         syllables = set([line.strip() for line in 
                 filter(lambda x:
                            x and "SYLL" not in x, syll_sec.split("\n"))])
 
-        nuclei = set([phone for phone in self.phones.keys() if self.phones[phone]["syll"] == TRUE])
+        nuclei = set([phone for phone in self.phones.keys() if feature_value(self.phones[phone], self.features, "syll") == TRUE])
         onsets = set([re.split("["+"".join(nuclei)+"]",syll)[0] for syll in syllables])
         codas = set([re.split("["+"".join(nuclei)+"]",syll)[1] for syll in syllables])
-        return {'syllables':syllables,'onsets':onsets,'codas':codas}
+        # onsets are matched walking back from the nucleus, so their trie holds them reversed
+        onset_trie = SyllableTrie()
+        for onset in onsets:
+            onset_trie.add(onset[::-1], self.phones)
+        coda_trie = SyllableTrie()
+        for coda in codas:
+            coda_trie.add(coda, self.phones)
+        return {'syllables':syllables,'onsets':onsets,'codas':codas,'onset_trie':onset_trie,'coda_trie':coda_trie}
 
     def parse_rules(self, rule_sec):
         """Create a new rule for each rule line:
@@ -94,3 +164,33 @@ class GlobalGrammar():
         
         #group rules by name
         return [(key, list(group)) for key, group in groupby(rule_list, lambda x: x.rule_name)]
+
+
+def load_grammar(filename, use_cache=True, cache_file=None):
+    """Parsed grammar for a config file.
+    The parsed grammar is kept in a binary cache file (by default next to the config)
+    keyed by a hash of the config's contents, and is only parsed again when the config changes"""
+    if not use_cache:
+        return GlobalGrammar(filename)
+    if cache_file is None:
+        cache_file = filename + ".cache"
+    with open(filename, "rb") as config:
+        key = hashlib.sha1("%d:%s" % (GRAMMAR_CACHE_VERSION, config.read())).hexdigest()
+    try:
+        with open(cache_file, "rb") as cached:
+            if cached.read(len(key)) == key:
+                return cPickle.load(cached)
+    except Exception:
+        # missing, stale or unreadable cache, parse again
+        pass
+    grammar = GlobalGrammar(filename)
+    try:
+        partial = cache_file + ".%d.tmp" % os.getpid()
+        with open(partial, "wb") as cached:
+            cached.write(key)
+            cPickle.dump(grammar, cached, cPickle.HIGHEST_PROTOCOL)
+        os.rename(partial, cache_file)
+    except (IOError, OSError):
+        # the cache is only an optimization, carry on without it
+        pass
+    return grammar
@@ -4,7 +4,7 @@
 import codecs
 from copy import copy
 import re
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from itertools import groupby
 import sys
 from Executor import *
@@ -20,10 +20,22 @@ SYLL = "σ".decode("utf-8")
 
 PADDING = 2
 
+# every distinct bundle made so far, so that equal bundles are one shared object
+BUNDLES = {}
+
+class FeatureBundle(namedtuple("FeatureBundle", ["defined", "values"])):
+    """Compact immutable set of features. Bit i of defined is set if the i-th feature of the
+    grammar is specified, bit i of values is set if that feature is +.
+    Bundles are interned: making a bundle equal to an existing one (unpickling included) returns that one"""
+    __slots__ = ()
+
+    def __new__(cls, defined, values):
+        bundle = tuple.__new__(cls, (defined, values))
+        return BUNDLES.setdefault(bundle, bundle)
+
 def get_features(feature_list, these_feature):
     """Translate list of features in format "+/-name1 +/-name2 into
-    dictionary of features given full list of possible features"""
-    features = {}
+    bundle of features given full list of possible features"""
     def feat_filter(feature, this):
         try:
             mapper = lambda x, feat: filter(lambda y: feat in y, x.split(" "))[0]
@@ -33,15 +45,41 @@ def get_features(feature_list, these_feature):
             return FALSE
         except:
             return UNDEF
-    for feat in feature_list:
-        features[feat] = feat_filter(feat, these_feature)
-    return features
+    defined = 0
+    values = 0
+    for i, feat in enumerate(feature_list):
+        val = feat_filter(feat, these_feature)
+        if val != UNDEF:
+            defined |= 1 << i
+            if val == TRUE:
+                values |= 1 << i
+    return FeatureBundle(defined, values)
+
+def feature_mask(feature_list, feature):
+    """Bit of a single feature in a bundle"""
+    return 1 << feature_list.index(feature)
+
+def feature_value(features, feature_list, feature):
+    """Look up TRUE/FALSE/UNDEF value of a single feature in a bundle"""
+    mask = feature_mask(feature_list, feature)
+    if not features.defined & mask:
+        return UNDEF
+    return TRUE if features.values & mask else FALSE
 
 def match_features(phone_feats, other_feats):
     """Determine whether two sets of features match.
     A phone is "matched" if every defined feature in the matching environment
     is matches the feature in phone"""
-    for feat in other_feats.keys():
-        if phone_feats[feat] != other_feats[feat] and other_feats[feat] != UNDEF:
-            return False
-    return True
+    phone_defined, phone_values = phone_feats
+    other_defined, other_values = other_feats
+    return not ((phone_values ^ other_values) | ~phone_defined) & other_defined
+
+def feature_distance(features, other):
+    """Count features whose values (including being undefined) differ between two bundles"""
+    return bin((features.defined ^ other.defined) | (features.values ^ other.values)).count("1")
+
+def update_features(features, change):
+    """Overwrite features with every defined feature of change"""
+    defined, values = features
+    change_defined, change_values = change
+    return FeatureBundle(defined | change_defined, (values & ~change_defined) | change_values)
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import itertools
+import sys
+from collections import OrderedDict
+from Executor import *
+from GlobalGrammar import *
+from RuleAnalysis import *
+
+# kinds of phones in a word state: ordinary phones, the padding shared by both ends, and # typed in a word
+SEGMENT = 0
+PADDING_PHONE = 1
+BREAK = 2
+
+
+def variants(options, limit):
+    """Ways of picking one option per position, those that depart from the first option
+    in the fewest positions first, at most limit of them"""
+    base = [choices[0] for choices in options]
+    flexible = [i for i, choices in enumerate(options) if len(choices) > 1]
+    count = 0
+    for departures in range(len(flexible) + 1):
+        for positions in itertools.combinations(flexible, departures):
+            for picks in itertools.product(*[options[i][1:] for i in positions]):
+                choice = list(base)
+                for i, pick in zip(positions, picks):
+                    choice[i] = pick
+                yield tuple(choice)
+                count += 1
+                if count >= limit:
+                    return
+
+
+class InverseDerivation(object):
+    """Recover the underlying representations a grammar maps to a surface form.
+    Rule blocks are undone last to first: each rule proposes the words it could have been applied to,
+    and a proposal is kept only if running the rule (or for syllable-aware rules the whole block)
+    forward on it gives back the word. Word states are tuples of (features, kind)"""
+
+    def __init__(self, grammar, max_branch=64, max_edits=1, max_states=2000, cache_size=100000):
+        self.grammar = grammar
+        self.executor = Executor(grammar, cache_size, block_cache_size=cache_size)
+        # words kept after undoing a rule or block, insertions or deletions undone per rule and word,
+        # and word states to undo blocks for per surface form
+        self.max_branch = max_branch
+        self.max_edits = max_edits
+        self.max_states = max_states
+        self.padding = grammar.phones[grammar.phone_char_mappings["#"]]
+        # characters of the phonemes a UR can be written with, by bundle
+        self.inventory = OrderedDict()
+        for name in grammar.phonemes:
+            if grammar.phone_char_mappings.get(name) in grammar.phones:
+                self.inventory.setdefault(grammar.phones[grammar.phone_char_mappings[name]], name)
+        # bundles that may be present before each rule, and at the end of a derivation
+        analysis = RuleAnalysis(grammar, list(self.inventory))
+        self.present, surface = analysis.present, analysis.surface
+        # bundles that may end up rendered as each character, closest to the character's own phone first
+        self.renderings = {}
+        for bundle in sorted(surface):
+            self.renderings.setdefault(self.executor.get_char_representation(Phone(bundle, "", False)), []).append(bundle)
+        for char, bundles in self.renderings.items():
+            exact = grammar.phones.get(grammar.phone_char_mappings.get(char))
+            bundles.sort(key=lambda bundle: (bundle != exact, feature_distance(bundle, exact) if exact else 0))
+        self.sources = {}
+        self.undone = LRUCache(cache_size)
+        # word states, by blocks still to undo, from which no UR could be recovered
+        self.dead = LRUCache(cache_size)
+
+    def to_word(self, state):
+        padding = None
+        word = []
+        for features, kind in state:
+            if kind == PADDING_PHONE:
+                if padding is None:
+                    padding = Phone(features, "#", False)
+                word.append(padding)
+            else:
+                word.append(Phone(features, "#" if kind == BREAK else "", False))
+        return word
+
+    def to_state(self, word):
+        return tuple((phone.features, PADDING_PHONE if phone is word[0] else BREAK if phone.name == "#" else SEGMENT)
+                     for phone in word)
+
+    def rule_sources(self, rule):
+        """Bundles the rule changes into each bundle, and bundles it can delete"""
+        if rule not in self.sources:
+            changes = {}
+            targets = []
+            for bundle in sorted(self.present[rule]):
+                if rule.matcher.insertion or not rule.matcher.match_seg(bundle):
+                    continue
+                targets.append((bundle, SEGMENT))
+                if not rule.matcher.resizes:
+                    changed = update_features(bundle, rule.seg_change)
+                    if changed != bundle:
+                        changes.setdefault(changed, []).append(bundle)
+            self.sources[rule] = (changes, targets)
+        return self.sources[rule]
+
+    def proposals(self, rule, state):
+        """Words the rule might have been applied to to give state, including state itself"""
+        changes, targets = self.rule_sources(rule)
+        syllables = rule.pre_syll_aware or rule.post_syll_aware
+        if rule.matcher.insertion:
+            inserted = [i for i, (features, kind) in enumerate(state) if kind == SEGMENT and features == rule.seg_change]
+            for edits in range(self.max_edits + 1):
+                for removed in itertools.combinations(inserted, edits):
+                    yield tuple(phone for i, phone in enumerate(state) if i not in removed)
+        elif rule.matcher.resizes:
+            yield state
+            gaps = range(1, len(state))
+            if not syllables:
+                # a phone deleted from a gap had the rest of the word as its environment
+                word = self.to_word(state)
+                for gap in gaps:
+                    for deleted in targets:
+                        if rule.matcher.match_env(word[:gap] + [Phone(deleted[0], "", False)] + word[gap:], gap):
+                            yield state[:gap] + (deleted,) + state[gap:]
+                first = 2
+            else:
+                first = 1
+            for edits in range(first, self.max_edits + 1):
+                for positions in itertools.combinations_with_replacement(gaps, edits):
+                    for deleted in itertools.product(targets, repeat=edits):
+                        word = list(state)
+                        for position, phone in reversed(zip(positions, deleted)):
+                            word.insert(position, phone)
+                        yield tuple(word)
+        else:
+            present = self.present[rule]
+            word = None
+            options = []
+            for i, (features, kind) in enumerate(state):
+                choices = [(features, kind)] if kind != SEGMENT or features in present else []
+                if kind == SEGMENT and features in changes:
+                    # phones before a changed one are already in their final state when it is reached
+                    if word is None:
+                        word = self.to_word(state)
+                    if syllables or rule.matcher.match_pre_env(word, i):
+                        choices += [(source, SEGMENT) for source in changes[features]]
+                if not choices:
+                    return
+                options.append(choices)
+            for word in variants(options, 16*self.max_branch):
+                yield word
+
+    def undo_rule(self, rule, state):
+        """Words that the rule turns into state. Without syllables in its environments the rule
+        is checked here, otherwise undo_block checks the block as a whole"""
+        checked = not (rule.pre_syll_aware or rule.post_syll_aware)
+        present = self.present[rule]
+        found = []
+        for word in self.proposals(rule, state):
+            if any(kind == SEGMENT and features not in present for features, kind in word):
+                continue
+            if checked and self.to_state(self.executor.apply_rule(rule, self.to_word(word))[0]) != state:
+                continue
+            found.append(word)
+            if len(found) >= self.max_branch:
+                break
+        return found
+
+    def forward(self, block, state):
+        name, rules = self.grammar.rules[block]
+        phones, form, index = self.executor.apply_block(block, rules, self.executor.syllabify(self.to_word(state)))
+        return self.to_state(phones)
+
+    def undo_block(self, block, state):
+        """Words that the block turns into state, at most max_branch of them"""
+        key = (block, state)
+        found = self.undone.get(key)
+        if found is not None:
+            return found
+        name, rules = self.grammar.rules[block]
+        words = [state]
+        for rule in reversed(rules):
+            earlier = OrderedDict()
+            for word in words:
+                for proposal in self.undo_rule(rule, word):
+                    earlier[proposal] = True
+                if len(earlier) >= self.max_branch:
+                    break
+            words = list(earlier)[:self.max_branch]
+        if any(rule.pre_syll_aware or rule.post_syll_aware for rule in rules):
+            found = tuple(word for word in words if self.forward(block, word) == state)
+        else:
+            # every rule was checked on its own already
+            found = tuple(words)
+        self.undone.put(key, found)
+        return found
+
+    def surface_states(self, SR):
+        """Words that render as SR, padded the way getUR pads words"""
+        options = []
+        for char in SR:
+            if char == u" ":
+                options.append([(self.padding, BREAK)])
+            elif char in self.renderings:
+                options.append([(bundle, SEGMENT) for bundle in self.renderings[char]])
+            else:
+                return
+        ends = [[(self.padding, PADDING_PHONE)]]*PADDING
+        for state in variants(ends + options + ends, self.max_states):
+            yield state
+
+    def spell(self, state):
+        """UR string of a word state, or None if it has phones no phoneme has"""
+        chars = []
+        for features, kind in state:
+            if kind == PADDING_PHONE:
+                continue
+            if kind == BREAK:
+                chars.append(u"#")
+            elif features in self.inventory:
+                chars.append(self.inventory[features])
+            else:
+                return None
+        return u"".join(chars).encode("utf-8")
+
+    def descend(self, blocks, state, found):
+        """Undo the first blocks rule blocks depth first from state, collecting the URs reached in found.
+        Returns whether any were"""
+        if blocks == 0:
+            UR = self.spell(state)
+            if UR is not None:
+                found[UR] = True
+            return UR is not None
+        key = (blocks, state)
+        if key in self.dead or self.expanded >= self.max_states:
+            return False
+        self.expanded += 1
+        reached = False
+        for earlier in self.undo_block(blocks - 1, state):
+            reached = self.descend(blocks - 1, earlier, found) or reached
+        if not reached and self.expanded < self.max_states:
+            self.dead.put(key, True)
+        return reached
+
+    def invert(self, SR):
+        """URs that derive SR, each checked by deriving it forward"""
+        found = OrderedDict()
+        self.expanded = 0
+        for state in self.surface_states(SR):
+            if self.expanded >= self.max_states:
+                break
+            self.descend(len(self.grammar.rules), state, found)
+        return [UR for UR in found if self.executor.derive(UR).sr == SR]
+
+    def invert_all(self, SRs):
+        for SR in SRs:
+            yield SR, self.invert(SR)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Find underlying representations that derive given surface forms")
+    parser.add_argument("config", help="grammar config file")
+    parser.add_argument("inputs", help="file of surface forms, one per line, - for stdin")
+    parser.add_argument("--max-branch", type=int, default=64,
+                        help="candidate words to keep after undoing each rule and rule block")
+    parser.add_argument("--max-edits", type=int, default=1,
+                        help="insertions or deletions to undo per rule and word")
+    parser.add_argument("--max-states", type=int, default=2000,
+                        help="word states to undo rule blocks for per surface form")
+    parser.add_argument("--no-grammar-cache", action="store_true",
+                        help="parse the config file instead of loading it from its .cache file")
+    options = parser.parse_args(args)
+    inverse = InverseDerivation(load_grammar(options.config, not options.no_grammar_cache),
+                                options.max_branch, options.max_edits, options.max_states)
+    SRs = (line.decode("utf-8").strip() for line in read_lines(options.inputs) if line.strip())
+    for SR, URs in inverse.invert_all(SRs):
+        sys.stdout.write((u"\t".join([SR] + [UR.decode("utf-8") for UR in URs]) + u"\n").encode("utf-8"))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import io
+import os
+import re
+import sys
+from Executor import *
+from GlobalGrammar import *
+
+
+def signature(grammar):
+    """Everything besides the rules that decides how a grammar reads, syllabifies and renders words.
+    Grammars with the same signature give the same results for the same rule blocks"""
+    return (tuple(grammar.features), tuple((phone, grammar.phones[phone]) for phone in grammar.phone_order),
+            tuple(sorted(grammar.phone_char_mappings.items())),
+            tuple(sorted(grammar.syllables["syllables"])))
+
+
+class BlockNode(object):
+    """Rule block in a prefix tree of the block sequences of several grammars.
+    grammars holds the positions of the grammars whose last block this is"""
+
+    __slots__ = ("id", "rules", "children", "grammars")
+
+    def __init__(self, id, rules):
+        self.id = id
+        self.rules = rules
+        self.children = OrderedDict()
+        self.grammars = []
+
+
+class GrammarGroup(object):
+    """Grammars with the same signature, their rule blocks merged into a prefix tree
+    so each word goes through a block shared by several of them only once"""
+
+    def __init__(self, grammar, cache_size):
+        self.executor = Executor(grammar, 0, block_cache_size=cache_size)
+        self.root = BlockNode(0, None)
+        self.nodes = 1
+
+    def add(self, position, grammar):
+        node = self.root
+        for name, rules in grammar.rules:
+            key = tuple(rule.rule_str for rule in rules)
+            if key not in node.children:
+                node.children[key] = BlockNode(self.nodes, rules)
+                self.nodes += 1
+            node = node.children[key]
+        node.grammars.append(position)
+
+    def derive(self, word, srs):
+        """Put a word (an input line or phone ids) through every grammar of the group,
+        setting srs at their positions. Returns the rendered UR"""
+        executor = self.executor
+        flat_word = word if isinstance(word, tuple) else re.sub(" ", "", word)
+        phones = executor.getUR_ids(flat_word) if isinstance(flat_word, tuple) else executor.getUR(flat_word)
+        phones = executor.syllabify(phones)
+        ur = executor.get_word_representation(phones)
+        self.descend(self.root, phones, None, srs)
+        return ur
+
+    def descend(self, node, phones, index, srs):
+        """Apply the blocks below node to a word that has been through node, depth first.
+        Only where grammars diverge is the word copied, once per extra branch"""
+        executor = self.executor
+        for position in node.grammars:
+            srs[position] = executor.get_word_representation(phones)
+        children = node.children.values()
+        if len(children) > 1:
+            frozen = executor.freeze(phones)
+        for k, child in enumerate(children):
+            if k > 0:
+                phones = executor.thaw(frozen)
+                index = None
+            branch, form, branch_index = executor.apply_block(child.id, child.rules, phones, index, False)
+            self.descend(child, branch, branch_index, srs)
+
+
+class MultiGrammar(object):
+    """Derive words through several grammars at once. Grammars are grouped by signature,
+    and within a group the work for rule blocks that grammars share from their start is done once,
+    so the cost grows with how much the grammars differ rather than with how many there are"""
+
+    def __init__(self, grammars, cache_size=0):
+        self.names = [name for name, grammar in grammars]
+        self.groups = []
+        groups = {}
+        for position, (name, grammar) in enumerate(grammars):
+            key = signature(grammar)
+            if key not in groups:
+                groups[key] = GrammarGroup(grammar, cache_size)
+                self.groups.append(groups[key])
+            groups[key].add(position, grammar)
+        self.blocks = sum(len(grammar.rules) for name, grammar in grammars)
+        # SR rows by input word
+        self.rows = LRUCache(cache_size)
+
+    def shared_blocks(self):
+        """Rule blocks applied per word, against the total over all grammars"""
+        return sum(group.nodes - 1 for group in self.groups), self.blocks
+
+    def derive(self, word):
+        """UR (as the first group renders it) and SR under each grammar, in grammar order"""
+        key = word if isinstance(word, tuple) else re.sub(" ", "", word)
+        row = self.rows.get(key)
+        if row is None:
+            srs = [None]*len(self.names)
+            urs = [group.derive(word, srs) for group in self.groups]
+            row = (urs[0], srs)
+            self.rows.put(key, row)
+        return row
+
+    def derive_all(self, words):
+        for word in words:
+            yield self.derive(word)
+
+    def read_inputs(self, source):
+        """Words of a binary lexicon file (as phone id tuples) or lines of any other input"""
+        if is_lexicon(source):
+            lexicon = BinaryLexicon(source)
+            for group in self.groups:
+                group.executor.read_lexicon(lexicon)
+            return iter(lexicon)
+        return read_lines(source)
+
+    def apply_to_inputs(self, source, output=None):
+        """Write a TSV table with the UR and the SR under each grammar for every input word"""
+        if output is None or output == "-":
+            sys.stdout.flush()
+            out = io.open(sys.stdout.fileno(), "w", buffering=1 << 16, encoding="utf-8", newline="\n", closefd=False)
+        else:
+            out = io.open(output, "w", buffering=1 << 16, encoding="utf-8", newline="\n")
+        try:
+            out.write(u"\t".join([u"UR"] + [name.decode("utf-8") for name in self.names]) + u"\n")
+            for ur, srs in self.derive_all(self.read_inputs(source)):
+                out.write(u"\t".join([ur] + srs) + u"\n")
+        finally:
+            out.close()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Derive one lexicon through several grammars, sharing the rule blocks they have in common")
+    parser.add_argument("inputs", help="input file, one UR per line, - for stdin, or a binary lexicon")
+    parser.add_argument("grammars", nargs="+", metavar="[NAME=]CONFIG",
+                        help="grammar config files, named by their file name unless NAME is given")
+    parser.add_argument("--output", help="file to write the SR table to instead of stdout")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="rows and rule block results to remember, worth it when input words repeat")
+    parser.add_argument("--no-grammar-cache", action="store_true",
+                        help="parse the config files instead of loading them from their .cache files")
+    parser.add_argument("--stats", action="store_true", help="report how many rule blocks were shared on stderr")
+    options = parser.parse_args(args)
+    grammars = []
+    for spec in options.grammars:
+        if "=" in spec:
+            name, config = spec.split("=", 1)
+        else:
+            name, config = os.path.splitext(os.path.basename(spec))[0], spec
+        grammars.append((name, load_grammar(config, not options.no_grammar_cache)))
+    multi = MultiGrammar(grammars, options.cache_size)
+    multi.apply_to_inputs(options.inputs, options.output)
+    if options.stats:
+        applied, total = multi.shared_blocks()
+        sys.stderr.write("%d grammars in %d groups: %d rule blocks per word instead of %d\n" %
+                         (len(grammars), len(multi.groups), applied, total))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import re
+import sys
+from Executor import *
+from GlobalGrammar import *
+
+
+def read_pairs(filename):
+    """(UR, SR) pairs from tab separated lines with the UR first and the SR last,
+    so TSV derivation output can be read back (word breaks in its URs are shown as spaces)"""
+    pairs = []
+    for line in read_lines(filename):
+        columns = line.split("\t")
+        if len(columns) < 2 or (columns[0] == "UR" and columns[-1] == "SR"):
+            continue
+        pairs.append((columns[0].replace(" ", "#"), columns[-1].decode("utf-8")))
+    return pairs
+
+
+class OrderExplorer(object):
+    """Find the orderings of a grammar's rule blocks under which every UR derives its attested SR.
+    Orderings are walked as a prefix tree, so the forms after a shared prefix are computed once,
+    and a subtree is abandoned as soon as some word can no longer reach its SR"""
+
+    def __init__(self, grammar, pairs, cache_size=100000, probe=16):
+        self.executor = Executor(grammar, 0)
+        self.blocks = grammar.rules
+        self.targets = [sr for ur, sr in pairs]
+        self.roots = [self.executor.freeze(self.executor.syllabify(self.executor.getUR(re.sub(" ", "", ur))))
+                      for ur, sr in pairs]
+        self.resizes = [any(rule.matcher.resizes for rule in rules) for name, rules in self.blocks]
+        # word after a block, by block and word before it
+        self.transitions = LRUCache(cache_size)
+        # characters a bundle can end up rendered as, by bundle and blocks still to apply
+        self.closures = {}
+        # order in which words are checked, and how many of them to check before the end of an ordering
+        self.order = range(len(pairs))
+        self.probe = probe
+        self.nodes = 0
+        self.pruned = 0
+
+    def step(self, block, state):
+        """Frozen word after applying block to a frozen word"""
+        key = (block, state)
+        result = self.transitions.get(key)
+        if result is None:
+            name, rules = self.blocks[block]
+            phones, form, index = self.executor.apply_block(block, rules, self.executor.thaw(state))
+            result = self.executor.freeze(phones)
+            self.transitions.put(key, result)
+        return result
+
+    def render(self, state):
+        return self.executor.get_word_representation(self.executor.thaw(state))
+
+    def reachable_chars(self, features, remaining):
+        """Every character a phone with these features could be rendered as after the remaining blocks.
+        Environments are ignored, so this may include characters that can never actually come about"""
+        key = (features, remaining)
+        if key not in self.closures:
+            rules = [rule for block in remaining for rule in self.blocks[block][1]]
+            self.closures[key] = frozenset(self.executor.get_char_representation(Phone(bundle, "", False))
+                                           for bundle in self.executor.grammar.closure([features], rules))
+        return self.closures[key]
+
+    def can_reach(self, state, target, remaining):
+        """False only if the word can certainly not derive target using the remaining blocks"""
+        if not remaining:
+            return self.render(state) == target
+        if any(self.resizes[block] for block in remaining):
+            # phones may still come and go, so there is no telling
+            return True
+        chars = [self.reachable_chars(phone[0], remaining) for phone in state]
+        if any(len(char) != 1 for options in chars for char in options):
+            return True
+        # rendered words are stripped, so padding at either end may render as blank
+        blank_before = [True]
+        for options in chars:
+            blank_before.append(blank_before[-1] and " " in options)
+        blank_after = [True]
+        for options in reversed(chars):
+            blank_after.append(blank_after[-1] and " " in options)
+        blank_after.reverse()
+        for start in range(len(chars) - len(target) + 1):
+            end = start + len(target)
+            if blank_before[start] and blank_after[end] and \
+                    all(target[k] in chars[start + k] for k in range(len(target))):
+                return True
+        return False
+
+    def state(self, prefix, path, word):
+        """Frozen word after the blocks in prefix, computed from the deepest ancestor that already has it.
+        path holds the words after each prefix of prefix, with None where they are not known yet"""
+        depth = len(prefix)
+        known = depth
+        while path[known][word] is None:
+            known -= 1
+        while known < depth:
+            path[known + 1][word] = self.step(prefix[known], path[known][word])
+            known += 1
+        return path[depth][word]
+
+    def check(self, prefix, path, remaining, words):
+        """Whether each of words can still reach its SR. A word that cannot is tried first next time,
+        since it will probably rule out other subtrees too"""
+        for word in words:
+            if not self.can_reach(self.state(prefix, path, word), self.targets[word], remaining):
+                self.order.remove(word)
+                self.order.insert(0, word)
+                return False
+        return True
+
+    def permutations(self, permute):
+        """expand function for every ordering that permutes the blocks in permute among their positions"""
+        everything = frozenset(range(len(self.blocks)))
+        permute = sorted(permute)
+
+        def expand(prefix):
+            remaining = everything.difference(prefix)
+            if len(prefix) == len(self.blocks):
+                return [], True, remaining
+            if len(prefix) not in permute:
+                return [len(prefix)], False, remaining
+            return [block for block in permute if block not in prefix], False, remaining
+        return expand
+
+    def prefix_tree(self, orderings):
+        """expand function for a given list of orderings"""
+        nodes = {(): [[], False, set()]}
+        for ordering in orderings:
+            ordering = tuple(ordering)
+            for depth in range(len(ordering) + 1):
+                prefix = ordering[:depth]
+                node = nodes.setdefault(prefix, [[], False, set()])
+                node[2].update(ordering[depth:])
+                if depth < len(ordering) and ordering[depth] not in node[0]:
+                    node[0].append(ordering[depth])
+            nodes[ordering][1] = True
+        for node in nodes.values():
+            node[2] = frozenset(node[2])
+        return lambda prefix: nodes[prefix]
+
+    def explore(self, orderings=None, permute=None, limit=None):
+        """Orderings (tuples of block positions in grammar.rules) under which every UR derives its SR.
+        Either the given orderings are tried, or all orderings of the blocks in permute
+        (default all blocks) with the other blocks left in place"""
+        if orderings is not None:
+            expand = self.prefix_tree(orderings)
+        else:
+            expand = self.permutations(range(len(self.blocks)) if permute is None else permute)
+        matches = []
+        self.walk((), [list(self.roots)], expand, matches, limit)
+        return matches
+
+    def walk(self, prefix, path, expand, matches, limit):
+        """Depth first search below prefix. Words are only taken as far as a check needs them,
+        so an ordering that fails on its first word costs about as much as that word's derivation"""
+        self.nodes += 1
+        children, complete, remaining = expand(prefix)
+        if remaining and not any(self.resizes[block] for block in remaining) and \
+                not self.check(prefix, path, remaining, self.order[:self.probe]):
+            self.pruned += 1
+            return
+        if complete and self.check(prefix, path, frozenset(), list(self.order)):
+            matches.append(prefix)
+        for block in children:
+            if limit is not None and len(matches) >= limit:
+                return
+            path.append([None]*len(self.targets))
+            self.walk(prefix + (block,), path, expand, matches, limit)
+            path.pop()
+
+    def names(self, ordering):
+        return [self.blocks[block][0].strip() for block in ordering]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Find rule block orderings that derive attested surface forms")
+    parser.add_argument("config", help="grammar config file")
+    parser.add_argument("pairs", help="tab separated file with a UR in the first and its SR in the last column")
+    parser.add_argument("--blocks", nargs="+", metavar="BLOCK",
+                        help="blocks to reorder, the others stay where they are (default all)")
+    parser.add_argument("--orderings", help="file of orderings to try instead, one per line as block names")
+    parser.add_argument("--limit", type=int, help="stop after finding this many orderings")
+    parser.add_argument("--cache-size", type=int, default=100000, help="block results to remember")
+    parser.add_argument("--no-grammar-cache", action="store_true",
+                        help="parse the config file instead of loading it from its .cache file")
+    options = parser.parse_args(args)
+    grammar = load_grammar(options.config, not options.no_grammar_cache)
+    explorer = OrderExplorer(grammar, read_pairs(options.pairs), options.cache_size)
+    positions = {}
+    for block, (name, rules) in enumerate(grammar.rules):
+        positions.setdefault(name.strip(), block)
+    try:
+        permute = [positions[name.decode("utf-8")] for name in options.blocks] if options.blocks else None
+        orderings = None
+        if options.orderings:
+            orderings = [[positions[name.decode("utf-8")] for name in line.split()]
+                         for line in read_lines(options.orderings) if line.strip()]
+    except KeyError as e:
+        parser.error("unknown block %s" % e)
+    for ordering in explorer.explore(orderings, permute, options.limit):
+        sys.stdout.write((u" ".join(explorer.names(ordering)) + u"\n").encode("utf-8"))
+    sys.stderr.write("%d nodes visited, %d subtrees pruned, %d block results computed (%d reused)\n" %
+                     (explorer.nodes, explorer.pruned, explorer.transitions.misses, explorer.transitions.hits))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
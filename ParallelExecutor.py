@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import deque
+import multiprocessing
+import os
+from Executor import *
+
+# executor of the current worker process, set once when the worker starts
+worker_executor = None
+
+def init_worker(executor):
+    global worker_executor
+    worker_executor = executor
+
+def derive_chunk(URstrs, trace=True):
+    """Derivations of a chunk, along with the worker's cache counters so far"""
+    return list(worker_executor.derive_all(URstrs, trace)), os.getpid(), worker_executor.cache_stats()
+
+def chunked(items, size):
+    """Split iterable into lists of size items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ParallelExecutor(object):
+    """Shard input lines across a pool of worker processes.
+    Each worker is handed the parsed grammar once when it starts, and results come back in input order"""
+
+    def __init__(self, executor, jobs, chunk_size=256):
+        self.executor = executor
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.worker_stats = {}
+
+    def derive_all(self, URstrs, trace=True):
+        """Derivations of input lines, in input order"""
+        pool = multiprocessing.Pool(self.jobs, init_worker, (self.executor,))
+        try:
+            # keep a few chunks per worker in flight rather than queueing the whole input
+            pending = deque()
+            for chunk in chunked(URstrs, self.chunk_size):
+                pending.append(pool.apply_async(derive_chunk, (chunk, trace)))
+                if len(pending) >= 2*self.jobs:
+                    for derivation in self.collect(pending.popleft()):
+                        yield derivation
+            while pending:
+                for derivation in self.collect(pending.popleft()):
+                    yield derivation
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def collect(self, result):
+        derivations, pid, stats = result.get()
+        self.worker_stats[pid] = stats
+        return derivations
+
+    def derive_stream(self, source, trace=True):
+        return self.derive_all(read_lines(source), trace)
+
+    def apply_to_inputs(self, filename, output=None, format="table", changed_by=None):
+        """Derive every line of filename in the workers, writing results in input order.
+        Words kept by changed_by are traced here rather than in the workers"""
+        writer = DerivationWriter(self.executor.grammar.rules, output, format, input_inventory(self.executor.grammar))
+        writer.write_header()
+        # a binary lexicon is opened before the workers start, so they know its phone ids
+        for derivation in select_derivations(self, self.executor.read_inputs(filename), writer.trace, changed_by,
+                                             self.executor):
+            writer.write(derivation)
+        writer.close()
+
+    def cache_stats(self):
+        """Cache counters summed over all workers"""
+        totals = {}
+        for stats in self.worker_stats.values():
+            for name, counts in stats.items():
+                total = totals.setdefault(name, dict.fromkeys(counts, 0))
+                for count in counts:
+                    total[count] += counts[count]
+        return totals
@@ -22,14 +22,15 @@ SYLL = "σ".decode("utf-8")
 class Phone(object):
     """Representation of phone. Contains feature information, character representation information, and syllabification related information"""
 
+    __slots__ = ("syll", "mora", "mapped", "name", "features", "touched")
+
     def __init__(self, features=None, phone=None, boundary=False):
         self.syll = -1
         self.mora = False
         self.mapped = phone
         self.name = phone
         self.features = features
-        self.to_delete = False
-        self.add_here = False
+        self.touched = False # changed since the word was last syllabified
 
     def __str__(self):
         """Don't use this. Unicode mess"""
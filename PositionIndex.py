@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+class PositionIndex(object):
+    """Inverted index from feature bundle to the positions of a word holding it"""
+
+    def __init__(self, word):
+        self.length = len(word)
+        self.positions = {}
+        # positions holding the same Phone object change together
+        self.shared = {}
+        seen = {}
+        for i, phone in enumerate(word):
+            if phone.features in self.positions:
+                self.positions[phone.features].add(i)
+            else:
+                self.positions[phone.features] = set([i])
+            first = seen.setdefault(id(phone), i)
+            if first != i:
+                group = self.shared.setdefault(first, [first])
+                group.append(i)
+                self.shared[i] = group
+
+    def move(self, index, old, new):
+        """Record that the phone at index changed from bundle old to new"""
+        positions = self.positions[old]
+        moved = self.shared.get(index, [index])
+        positions.difference_update(moved)
+        if not positions:
+            del self.positions[old]
+        self.positions.setdefault(new, set()).update(moved)
+
+    def candidates(self, matcher):
+        """Sorted positions that could satisfy the target of a rule's matcher"""
+        if matcher.insertion:
+            return range(self.length)
+        found = []
+        triggers = matcher.triggers
+        for features, positions in self.positions.iteritems():
+            if triggers[features] if features in triggers else matcher.triggered_by(features):
+                found.extend(positions)
+        found.sort()
+        return found
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import json
+import sys
+import time
+
+COUNTERS = ["calls", "visited", "seg_hits", "env_checks", "env_hits", "changes", "insertions", "deletions"]
+
+
+class RuleProfile(object):
+    """What one rule did over a run: how often it was applied, positions visited, target matches,
+    environment checks and matches, feature changes, insertions, deletions and wall time"""
+
+    __slots__ = ["rule"] + COUNTERS + ["time"]
+
+    def __init__(self, rule):
+        self.rule = rule
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        self.time = 0.0
+
+    def record(self):
+        record = OrderedDict([("block", self.rule.rule_name.strip()), ("rule", self.rule.rule_str)])
+        for counter in COUNTERS:
+            record[counter] = getattr(self, counter)
+        record["time"] = self.time
+        return record
+
+
+class BlockProfile(object):
+    """Rule block totals over a run. time includes resyllabifying and cache lookups,
+    cached counts the words whose result for the block came from the cache"""
+
+    __slots__ = ["name", "calls", "cached", "time"]
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.cached = 0
+        self.time = 0.0
+
+
+class Profiler(object):
+    """Per-rule and per-block counts and timings for an Executor.
+    Set executor.profiler to a Profiler to start collecting, and back to None to stop"""
+
+    def __init__(self):
+        self.rules = OrderedDict()
+        self.blocks = OrderedDict()
+        # calls and wall time of syllabify and resyllabify
+        self.stages = OrderedDict((stage, [0, 0.0]) for stage in ["syllabify", "resyllabify"])
+
+    def rule_profile(self, rule):
+        profile = self.rules.get(rule)
+        if profile is None:
+            profile = self.rules[rule] = RuleProfile(rule)
+        return profile
+
+    def apply_rule(self, executor, rule, word, index=None):
+        """executor.apply_rule, counted and timed"""
+        profile = self.rule_profile(rule)
+        started = time.time()
+        result = executor.apply_rule(rule, word, index, profile)
+        profile.time += time.time() - started
+        profile.calls += 1
+        return result
+
+    def time_stage(self, stage, function, word):
+        started = time.time()
+        result = function(word)
+        stats = self.stages.setdefault(stage, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.time() - started
+        return result
+
+    def add_block(self, rules, seconds, cached):
+        name = rules[0].rule_name.strip()
+        profile = self.blocks.get(name)
+        if profile is None:
+            profile = self.blocks[name] = BlockProfile(name)
+        profile.calls += 1
+        profile.cached += cached
+        profile.time += seconds
+
+    def block_records(self):
+        """Block totals, with the counters of their rules summed"""
+        records = OrderedDict()
+        for name, profile in self.blocks.items():
+            records[name] = OrderedDict([("block", name), ("calls", profile.calls), ("cached", profile.cached)] +
+                                        [(counter, 0) for counter in COUNTERS[1:]] +
+                                        [("rule_time", 0.0), ("time", profile.time)])
+        for profile in self.rules.values():
+            record = records.get(profile.rule.rule_name.strip())
+            if record is not None:
+                for counter in COUNTERS[1:]:
+                    record[counter] += getattr(profile, counter)
+                record["rule_time"] += profile.time
+        return records.values()
+
+    def dump(self):
+        """Everything collected, as a dictionary ready for JSON"""
+        return OrderedDict([("stages", OrderedDict((stage, {"calls": calls, "time": seconds})
+                                                   for stage, (calls, seconds) in self.stages.items())),
+                            ("blocks", self.block_records()),
+                            ("rules", [profile.record() for profile in self.rules.values()])])
+
+    def save(self, filename):
+        with open(filename, "w") as saved:
+            json.dump(self.dump(), saved, indent=2)
+
+    def summary(self, out=sys.stderr, top=None):
+        """Readable report of blocks and rules, most expensive first"""
+        write_line(out, "%-16s %8s %10s" % ("stage", "calls", "time"))
+        for stage, (calls, seconds) in self.stages.items():
+            write_line(out, "%-16s %8d %9.4fs" % (stage, calls, seconds))
+        write_line(out, "\n%-16s %8s %8s %10s %10s" % ("block", "calls", "cached", "changes", "time"))
+        for record in sorted(self.block_records(), key=lambda record: -record["time"])[:top]:
+            write_line(out, u"%-16s %8d %8d %10d %9.4fs" %
+                       (record["block"], record["calls"], record["cached"],
+                        record["changes"] + record["insertions"] + record["deletions"], record["time"]))
+        write_line(out, "\n%-48s %8s %10s %9s %9s %9s %8s %8s %8s %10s" %
+                   ("rule", "calls", "visited", "seg hits", "env chks", "env hits", "changes", "inserts", "deletes", "time"))
+        for profile in sorted(self.rules.values(), key=lambda profile: -profile.time)[:top]:
+            label = (u"%s: %s" % (profile.rule.rule_name.strip(), profile.rule.rule_str))[:48]
+            write_line(out, u"%-48s %8d %10d %9d %9d %9d %8d %8d %8d %9.4fs" %
+                       ((label,) + tuple(getattr(profile, counter) for counter in COUNTERS) + (profile.time,)))
+
+
+def write_line(out, line):
+    if isinstance(line, unicode):
+        line = line.encode("utf-8")
+    out.write(line + "\n")
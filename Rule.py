@@ -9,6 +9,7 @@ from itertools import groupby
 import sys
 from Phone import *
 from Globals import *
+from RuleMatcher import *
 
 
 class Rule(object):
@@ -68,6 +69,10 @@ class Rule(object):
 
         self.seg_match_str = rule_list[0]
         self.seg_change_str = rule_list[1]
+        self.matcher = RuleMatcher(self)
+        # the phone an insertion rule inserts, looked up here once instead of at every insertion
+        self.insert_char = self.seg_change_str.strip() if self.matcher.insertion else None
+        self.insert_features = self.seg_change if self.matcher.insertion else None
 
     def count_syll_offsets(self, env, pre):
         acc = 0
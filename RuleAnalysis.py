@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+from collections import OrderedDict
+from GlobalGrammar import *
+
+
+def matches(options, features):
+    """determine if a bundle matches any of a segment's options"""
+    defined, values = features
+    for option in options:
+        if not ((values ^ option.values) | ~defined) & option.defined:
+            return True
+    return False
+
+
+class RuleAnalysis(object):
+    """What the rules of a grammar can do, worked out from the grammar alone.
+    Every set here is a superset of what derivations actually produce (environments are mostly
+    ignored), so a rule found dead can never apply, and rules found not to interact never do"""
+
+    def __init__(self, grammar, bundles=None):
+        self.grammar = grammar
+        self.rules = [rule for name, block in grammar.rules for rule in block]
+        self.padding = grammar.phones[grammar.phone_char_mappings["#"]]
+        if bundles is None:
+            # URs may be written with any phone or abbreviation character
+            bundles = grammar.phones.values()
+        self.present, self.produced, self.surface, self.padded = self.reachable(bundles)
+        self.dead = set(rule for rule in self.rules if not self.can_apply(rule))
+        self.edges = None
+
+    def reachable(self, bundles):
+        """Bundles that may be present before each rule, bundles each rule may produce,
+        bundles that may be present at the end of a derivation, and bundles the padding may have before each rule.
+        A rule without an environment certainly changes or deletes every phone it matches"""
+        present = set(bundles)
+        present.add(self.padding)
+        padding = set([self.padding])
+        before = {}
+        produced = {}
+        padded = {}
+        for rule in self.rules:
+            before[rule] = frozenset(present)
+            padded[rule] = frozenset(padding)
+            if rule.matcher.insertion:
+                produced[rule] = frozenset([rule.insert_features])
+                present.update(produced[rule])
+                continue
+            matched = [bundle for bundle in present if rule.matcher.match_seg(bundle)]
+            if rule.matcher.resizes:
+                produced[rule] = frozenset()
+            else:
+                produced[rule] = frozenset(update_features(bundle, rule.seg_change) for bundle in matched)
+                padding.update([update_features(bundle, rule.seg_change) for bundle in padding
+                                if rule.matcher.match_seg(bundle)])
+            if not rule.matcher.has_env:
+                present.difference_update(matched)
+            present.update(produced[rule])
+        return before, produced, frozenset(present), padded
+
+    def environment(self, rule):
+        """Segments of the rule's environments, each a list of options"""
+        return (rule.pre_env or []) + (rule.post_env or [])
+
+    def can_apply(self, rule):
+        """False only if no word can ever satisfy the rule's target and environment.
+        A rule's environment may include phones it has just changed itself"""
+        available = self.present[rule] | self.produced[rule]
+        if not rule.matcher.insertion and not any(rule.matcher.match_seg(bundle) for bundle in self.present[rule]):
+            return False
+        return all(any(matches(options, bundle) for bundle in available) for options in self.environment(rule))
+
+    def changes(self, rule, bundles):
+        """(before, after) pairs for what the rule may do to phones with these bundles.
+        after is None for a deletion, before is None for an insertion"""
+        if rule.matcher.insertion:
+            return [(None, rule.insert_features)]
+        pairs = []
+        for bundle in bundles:
+            if rule.matcher.match_seg(bundle):
+                if rule.matcher.resizes:
+                    pairs.append((bundle, None))
+                else:
+                    changed = update_features(bundle, rule.seg_change)
+                    if changed != bundle:
+                        pairs.append((bundle, changed))
+        return pairs
+
+    def effects(self, rule, later, bundles):
+        """How the rule may change whether later rule applies: a set holding "feeds" if it may
+        make later's target or environment match where it did not, and "bleeds" if the reverse"""
+        tests = self.environment(later)
+        if not later.matcher.insertion:
+            tests = [later.seg_match] + tests
+        found = set()
+        for before, after in self.changes(rule, bundles):
+            if before is None or after is None:
+                # phones coming or going also move environments together or apart
+                if later.matcher.has_env:
+                    found.update(["feeds", "bleeds"])
+            for options in tests:
+                was = before is not None and matches(options, before)
+                now = after is not None and matches(options, after)
+                if now and not was:
+                    found.add("feeds")
+                elif was and not now:
+                    found.add("bleeds")
+            if len(found) == 2:
+                break
+        return found
+
+    def graph(self):
+        """Feeding and bleeding edges (earlier rule, later rule, "feeds" or "bleeds") between live rules"""
+        if self.edges is None:
+            self.edges = []
+            live = [rule for rule in self.rules if rule not in self.dead]
+            for i, rule in enumerate(live):
+                for later in live[i + 1:]:
+                    for kind in sorted(self.effects(rule, later, self.present[rule])):
+                        self.edges.append((rule, later, kind))
+        return self.edges
+
+    def independent(self, rules):
+        """Whether applying rules position by position in a single pass is the same as applying
+        them one after another: none of them resizes the word, none can change what another matches,
+        and no two can change the padding. The padding is one phone at several positions, so in a single pass
+        a rule changing it at a later position would undo what a later rule did to it at an earlier one"""
+        if any(rule.matcher.resizes for rule in rules):
+            return False
+        padding = self.grammar.closure(self.padded[rules[0]], rules)
+        if sum(any(rule.matcher.match_seg(bundle) for bundle in padding) for rule in rules) > 1:
+            return False
+        bundles = self.grammar.closure(self.present[rules[0]], rules)
+        for rule in rules:
+            for other in rules:
+                if other is not rule and self.effects(rule, other, bundles):
+                    return False
+        return True
+
+    def plan(self):
+        """Steps to carry out per block, in order: each a tuple of rules applied in one pass.
+        Dead rules are left out and adjacent live rules are fused while they stay independent"""
+        plan = []
+        for name, block in self.grammar.rules:
+            steps = []
+            for rule in block:
+                if rule in self.dead:
+                    continue
+                if steps and self.independent(steps[-1] + (rule,)):
+                    steps[-1] += (rule,)
+                else:
+                    steps.append((rule,))
+            plan.append(steps)
+        return plan
+
+    def report(self, out=sys.stdout):
+        """Readable summary of dead rules, feeding and bleeding, and the fused plan"""
+        label = lambda rule: u"%s: %s" % (rule.rule_name.strip(), rule.rule_str)
+        lines = [u"dead rules:"]
+        lines += [u"  " + label(rule) for rule in self.rules if rule in self.dead] or [u"  none"]
+        lines.append(u"interactions:")
+        lines += [u"  %s %s %s" % (label(rule), kind, label(later)) for rule, later, kind in self.graph()] or [u"  none"]
+        lines.append(u"plan:")
+        for steps in self.plan():
+            for step in steps:
+                lines.append(u"  " + u" + ".join(label(rule) for rule in step))
+        for line in lines:
+            out.write((line + u"\n").encode("utf-8"))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Report dead rules, rule interactions and fusable rules of a grammar")
+    parser.add_argument("config", help="grammar config file")
+    parser.add_argument("--no-grammar-cache", action="store_true",
+                        help="parse the config file instead of loading it from its .cache file")
+    options = parser.parse_args(args)
+    RuleAnalysis(load_grammar(options.config, not options.no_grammar_cache)).report()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import argparse
 import codecs
 from copy import copy
 import re
@@ -10,12 +11,74 @@ from Executor import *
 from GlobalGrammar import *
 
 def main(args):
-    grammar = Executor(GlobalGrammar(args[0]))
-    grammar.apply_to_inputs(args[1])
+    parser = argparse.ArgumentParser(description="Apply ordered rule phonology to a file of underlying representations")
+    parser.add_argument("config", help="grammar config file")
+    parser.add_argument("inputs", help="input file, one UR per line, - for stdin")
+    parser.add_argument("--format", choices=FORMATS, default="table",
+                        help="readable derivation table, one derivation per line as TSV or JSON Lines, "
+                             "or just UR and SR per line (sr, which skips rendering the forms after each block)")
+    parser.add_argument("--changed-by", nargs="+", metavar="BLOCK",
+                        help="only write derivations of words that one of these rule blocks changed")
+    parser.add_argument("--output", help="file to write derivations to instead of stdout")
+    parser.add_argument("--engine", choices=["executor", "batch"], default="executor",
+                        help="executor applies rules word by word, batch applies each rule to many words at once with numpy")
+    parser.add_argument("--batch-size", type=int, default=1024, help="words per batch for the batch engine")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="derivations to remember by input line, 0 to turn memoization off")
+    parser.add_argument("--block-cache-size", type=int, default=0,
+                        help="rule block results to remember by incoming word, worth it only when many words "
+                             "reach a block in the same state")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes to shard input lines across")
+    parser.add_argument("--chunk-size", type=int, default=256, help="input lines handed to a worker at a time")
+    parser.add_argument("--no-grammar-cache", action="store_true",
+                        help="parse the config file instead of loading it from its .cache file")
+    parser.add_argument("--cache-stats", action="store_true", help="report cache hits and misses on stderr")
+    parser.add_argument("--optimize", action="store_true",
+                        help="skip rules that can never apply and apply independent adjacent rules in one pass")
+    parser.add_argument("--profile", nargs="?", const="", metavar="FILE",
+                        help="report per-rule counts and timings on stderr, and save them to FILE as JSON if given")
+    options = parser.parse_args(args)
+    if options.format == "lexicon" and (options.output is None or options.output == "-"):
+        parser.error("--format lexicon needs an --output file")
+    if options.profile is not None and (options.engine != "executor" or options.jobs > 1):
+        parser.error("--profile needs the executor engine and a single job")
+    if options.engine == "batch":
+        from BatchExecutor import BatchExecutor
+        grammar = BatchExecutor(load_grammar(options.config, not options.no_grammar_cache), options.batch_size)
+    else:
+        grammar = Executor(load_grammar(options.config, not options.no_grammar_cache), options.cache_size,
+                           options.optimize, options.block_cache_size)
+    if is_lexicon(options.inputs):
+        try:
+            with BinaryLexicon(options.inputs) as lexicon:
+                unknown = unknown_phones(lexicon, grammar.grammar)
+        except ValueError as e:
+            parser.error(str(e))
+        if unknown:
+            parser.error((u"%s has phones the grammar does not: %s" % (options.inputs.decode("utf-8"), u" ".join(unknown))).encode("utf-8"))
+    changed_by = None
+    if options.changed_by:
+        names = [name.decode("utf-8") for name in options.changed_by]
+        changed_by = set(block for block, (name, rules) in enumerate(grammar.grammar.rules) if name.strip() in names)
+        unknown = set(names).difference(name.strip() for name, rules in grammar.grammar.rules)
+        if unknown:
+            parser.error("unknown block %s" % ", ".join(sorted(unknown)).encode("utf-8"))
+    if options.profile is not None:
+        from Profiler import Profiler
+        grammar.profiler = Profiler()
+    if options.jobs > 1:
+        from ParallelExecutor import ParallelExecutor
+        grammar = ParallelExecutor(grammar, options.jobs, options.chunk_size)
+    grammar.apply_to_inputs(options.inputs, options.output, options.format, changed_by)
+    if options.cache_stats:
+        for name, stats in sorted(grammar.cache_stats().items()):
+            sys.stderr.write("%s cache: %d hits, %d misses, %d/%d entries\n" %
+                             (name, stats["hits"], stats["misses"], stats["size"], stats["maxsize"]))
+    if options.profile is not None:
+        grammar.profiler.summary(sys.stderr)
+        if options.profile:
+            grammar.profiler.save(options.profile)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        raise ValueError("Correct Usage: python RuleApplication.py <config file> <input file>")
     main(sys.argv[1:])
-
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from Globals import *
+
+
+class RuleMatcher(object):
+    """Rule compiled into flat position-relative tests on feature masks.
+    A word is scanned left to right in a single pass without building any lists"""
+
+    def __init__(self, rule):
+        break_mask = feature_mask(rule.features, "break")
+        self.insertion = [None] in rule.seg_match
+        self.resizes = self.insertion or None in rule.seg_change
+        self.seg_options = () if self.insertion else tuple(rule.seg_match)
+        # trigger signature: bundles already known to satisfy the target or not
+        self.triggers = {}
+        # what the rule's feature change turns each bundle into, worked out once per bundle
+        self.seg_change = None if self.resizes else rule.seg_change
+        self.changes = {}
+        self.has_env = bool(rule.has_env())
+        self.pre_env = None
+        self.post_env = None
+        if self.has_env:
+            self.pre_env = self.compile_env(rule.pre_env, rule.pre_env_sylls, rule.pre_syll_aware, break_mask)
+            if rule.post_env:
+                self.post_env = self.compile_env(rule.post_env, rule.post_env_sylls, rule.post_syll_aware, break_mask)
+
+    def compile_env(self, env, offsets, syll_aware, break_mask):
+        """Turn environment into (syllable offset, options) per segment.
+        Offset is None when the environment is not syllable-aware"""
+        return tuple((offsets[i] if syll_aware else None,
+                      tuple((option.defined, option.values, bool(option.values & break_mask)) for option in options))
+                     for i, options in enumerate(env))
+
+    def match_seg(self, features):
+        """determine if a bundle matches the rule's target"""
+        if self.insertion:
+            return True
+        defined, values = features
+        for option_defined, option_values in self.seg_options:
+            if not ((values ^ option_values) | ~defined) & option_defined:
+                return True
+        return False
+
+    def triggered_by(self, features):
+        """determine (once per bundle) if phones with these features can be the rule's target"""
+        if features not in self.triggers:
+            self.triggers[features] = self.match_seg(features)
+        return self.triggers[features]
+
+    def change(self, features):
+        """bundle the rule's feature change turns features into"""
+        changed = self.changes.get(features)
+        if changed is None:
+            changed = self.changes[features] = update_features(features, self.seg_change)
+        return changed
+
+    def match_env(self, word, index):
+        """determine if the phone at index is in the rule's environment"""
+        if not self.has_env:
+            return True
+        n = len(word)
+        pivot = index + 1 if self.insertion else index
+        start = pivot - len(self.pre_env)
+        if start < 0:
+            # environments reaching past the start of the word wrap around like a slice
+            start = max(n + start, 0)
+        if start >= n or not self.match_segs(self.pre_env, word, start, pivot, n):
+            return False
+        if self.post_env is None:
+            return True
+        if index + 1 >= n:
+            return False
+        return self.match_segs(self.post_env, word, index + 1, index, n)
+
+    def match_pre_env(self, word, index):
+        """determine if the phones before index match the rule's environment, whatever follows"""
+        if not self.has_env:
+            return True
+        n = len(word)
+        pivot = index + 1 if self.insertion else index
+        start = pivot - len(self.pre_env)
+        if start < 0:
+            start = max(n + start, 0)
+        return start < n and self.match_segs(self.pre_env, word, start, pivot, n)
+
+    def match_segs(self, env, word, start, pivot, n):
+        """match compiled environment against the word starting at start"""
+        for k, (offset, options) in enumerate(env):
+            pos = start + k
+            if pos >= n:
+                return False
+            phone = word[pos]
+            defined, values = phone.features
+            for option_defined, option_values, boundary in options:
+                if ((values ^ option_values) | ~defined) & option_defined:
+                    continue
+                if offset is None or (phone.syll < 0 and boundary) or \
+                        (pivot < n and offset + word[pivot].syll == phone.syll):
+                    break
+            else:
+                return False
+        return True
+
+    def scan(self, word, positions=None):
+        """Yield every position the rule applies at, left to right, out of positions (default all).
+        Each position is tested against the word as it stands when it is reached,
+        so changes made to earlier positions are seen by later ones"""
+        for i in positions if positions is not None else xrange(len(word)):
+            if self.match_seg(word[i].features) and self.match_env(word, i):
+                yield i
+
+    def scan_counted(self, word, positions, stats):
+        """scan, counting positions visited, target matches, and environment checks and matches in stats"""
+        for i in positions if positions is not None else xrange(len(word)):
+            stats.visited += 1
+            if not self.match_seg(word[i].features):
+                continue
+            stats.seg_hits += 1
+            if self.has_env:
+                stats.env_checks += 1
+                if not self.match_env(word, i):
+                    continue
+                stats.env_hits += 1
+            yield i
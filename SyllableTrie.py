@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from Globals import *
+
+
+class SyllableTrie(object):
+    """Trie of syllable templates (onsets or codas), one template character per level.
+    Nodes where a template ends hold its length not counting word boundaries"""
+
+    __slots__ = ("features", "length", "children")
+
+    def __init__(self, features=None):
+        self.features = features
+        self.length = None
+        self.children = {}
+
+    def add(self, template, phones):
+        node = self
+        for char in template:
+            if char not in node.children:
+                node.children[char] = SyllableTrie(phones[char])
+            node = node.children[char]
+        node.length = len(template) - template.count("#")
+
+    def longest(self, word, sylls, start, step):
+        """Length of the longest template matching phones not yet in a syllable,
+        walking from start in direction step"""
+        best = 0
+        stack = [(self, start)]
+        while stack:
+            node, pos = stack.pop()
+            if node.length > best:
+                best = node.length
+            if pos < 0 or pos >= len(word) or sylls[pos] >= 0:
+                continue
+            features = word[pos].features
+            for child in node.children.values():
+                if match_features(features, child.features):
+                    stack.append((child, pos + step))
+        return best